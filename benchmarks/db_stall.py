@@ -0,0 +1,128 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Measure how long database calls stall the asyncio event loop.
+
+Runs the same handler-like workload against a SQLite database with artificial per-query latency,
+once calling the blocking SQLAlchemy methods directly on the event loop (the old behavior) and
+once through the executor-backed async methods in :mod:`supportportal.db`.
+
+Usage: python -m benchmarks.db_stall [--latency MS] [--handlers N] [--rounds N]
+"""
+from typing import Awaitable, Callable, List, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.declarative import declarative_base
+
+from mautrix.util.db import BaseClass
+
+from supportportal.db import Case, ControlEvent, CaseAccept
+
+Tables = Tuple[type, type, type]
+
+
+def make_tables(latency: float) -> Tables:
+    path = os.path.join(tempfile.mkdtemp(prefix="supportportal-bench-"), "bench.db")
+    engine = create_engine(f"sqlite:///{path}")
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def inject_latency(*_) -> None:
+        time.sleep(latency)
+
+    base = declarative_base(cls=BaseClass, bind=engine)
+    tables = (Case.copy(bind=engine, rebase=base), ControlEvent.copy(bind=engine, rebase=base),
+              CaseAccept.copy(bind=engine, rebase=base))
+    base.metadata.create_all()
+    executor = ThreadPoolExecutor(max_workers=1)
+    for table in tables:
+        table.executor = executor
+    return tables
+
+
+async def blocking_handler(tables: Tables, n: int) -> None:
+    case_cls, ctrl_cls, _ = tables
+    room_id = f"!room{n}:example.com"
+    case = case_cls.get.__wrapped__(case_cls, room_id)
+    if not case:
+        case = case_cls(id=room_id, room_name="", last_bot_msg=0)
+        BaseClass.insert(case)
+    ctrl_cls.latest_for_case.__wrapped__(ctrl_cls, room_id)
+    BaseClass.edit(case, last_bot_msg=n)
+
+
+async def async_handler(tables: Tables, n: int) -> None:
+    case_cls, ctrl_cls, _ = tables
+    room_id = f"!room{n}:example.com"
+    case = await case_cls.get(room_id)
+    if not case:
+        case = case_cls(id=room_id, room_name="", last_bot_msg=0)
+        await case.insert()
+    await ctrl_cls.latest_for_case(room_id)
+    await case.edit(last_bot_msg=n)
+
+
+async def measure(handler: Callable[[Tables, int], Awaitable[None]], tables: Tables,
+                  handlers: int, rounds: int, tick: float = 0.001) -> Tuple[float, List[float]]:
+    stalls: List[float] = []
+    done = False
+
+    async def ticker() -> None:
+        while not done:
+            before = time.perf_counter()
+            await asyncio.sleep(tick)
+            stalls.append(max(0.0, time.perf_counter() - before - tick))
+
+    ticker_task = asyncio.ensure_future(ticker())
+    await asyncio.sleep(tick)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        await asyncio.gather(*(handler(tables, n) for n in range(handlers)))
+    duration = time.perf_counter() - start
+    done = True
+    await ticker_task
+    return duration, stalls
+
+
+def report(name: str, duration: float, stalls: List[float]) -> None:
+    stalls = sorted(stalls)
+    p99 = stalls[int(len(stalls) * 0.99)] if stalls else 0
+    print(f"{name:>9}: total {duration * 1000:8.1f} ms, "
+          f"max stall {stalls[-1] * 1000 if stalls else 0:7.1f} ms, "
+          f"p99 stall {p99 * 1000:7.1f} ms, "
+          f"stalled {sum(stalls) * 1000:8.1f} ms over {len(stalls)} ticks")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Measure event loop stalls caused by DB calls")
+    parser.add_argument("--latency", type=float, default=5, help="Injected latency per query (ms)")
+    parser.add_argument("--handlers", type=int, default=20, help="Concurrent handlers per round")
+    parser.add_argument("--rounds", type=int, default=5, help="Number of rounds")
+    args = parser.parse_args()
+
+    latency = args.latency / 1000
+    report("blocking", *await measure(blocking_handler, make_tables(latency),
+                                      args.handlers, args.rounds))
+    report("executor", *await measure(async_handler, make_tables(latency),
+                                      args.handlers, args.rounds))
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
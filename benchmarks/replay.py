@@ -0,0 +1,524 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Replay event traces through the plugin and measure how it performs.
+
+Events are dispatched through the same mautrix syncer and maubot handler registration that a real
+bot uses, so every handler of the plugin runs as it would in production. The homeserver is
+replaced by an in-process fake client with a configurable latency per API call, and the plugin
+uses a fresh SQLite database. Nothing is sent over the network.
+
+Traces are split into phases, which are replayed one after another. All events of a phase are
+dispatched at once (like a large sync response) or at a fixed rate with ``--rate``, and the phase
+ends once every handler, queued room event, queued outbound request and pending status edit has
+finished. For each phase, the events per second, the p50/p99 latency from dispatching an event to
+all of its handlers finishing, the database queries per event and the API calls per event are
+reported.
+
+Traces are JSONL files with one Matrix event per line (as found in the timeline of a sync
+response, including ``room_id``). A ``{"phase": "name"}`` line starts a new phase. Because the
+control events are created during the replay, reactions and replies can refer to the latest
+control event of a case as ``$latest:<case room ID>``.
+
+Several replay processes can share a database with ``--database`` to try out coordination
+between instances. With ``--barrier``, the processes wait for each other before every phase, so
+that the control events referred to by a phase exist no matter which instance created them.
+With ``--leave-after``, the first process that holds leases stops after the given phase, and the
+other processes have to take over its rooms.
+
+Usage: python -m benchmarks.replay [SCENARIO] [--cases N] [--agents N] [--messages N]
+                                   [--latency MS] [--rate N] [--set KEY=VALUE]
+                                   [--trace FILE] [--save-trace FILE] [--json]
+                                   [--database URL] [--barrier DIR --instances N]
+                                   [--leave-after PHASE]
+"""
+from typing import Any, Callable, Dict, List, Optional, Tuple
+from collections import Counter, defaultdict
+from contextvars import ContextVar
+import argparse
+import asyncio
+import json
+import logging
+import os
+import tempfile
+import time
+
+from ruamel.yaml import YAML
+from sqlalchemy import create_engine, event
+
+from mautrix.client import SyncStream
+from mautrix.client.syncer import Syncer
+from mautrix.types import (JSON, Event, EventType, FilterID, Member, Membership,
+                           MemberStateEventContent, MessageEvent, RoomNameStateEventContent)
+from mautrix.util.config import RecursiveDict
+from maubot.matrix import MaubotMessageEvent
+
+from supportportal import SupportPortalBot
+from supportportal.config import Config
+
+BOT_MXID = "@support:bench"
+CONTROL_ROOM = "!control:bench"
+BASE_CONFIG = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                           "base-config.yaml")
+
+Phase = Tuple[str, List[Dict[str, Any]]]
+
+_current_event: ContextVar[Optional[str]] = ContextVar("current_event", default=None)
+
+
+class FakeClient(Syncer):
+    """A Matrix client that keeps room state in memory instead of talking to a homeserver."""
+
+    def __init__(self, latency: float, log: logging.Logger) -> None:
+        super().__init__(None)
+        self.mxid = BOT_MXID
+        self.disable_replies = False
+        self.latency = latency
+        self.log = log
+        self.calls = Counter()
+        self.members: Dict[str, Dict[str, Member]] = defaultdict(dict)
+        self.room_names: Dict[str, str] = {}
+        self.tasks: List[asyncio.Task] = []
+        self.finished: Dict[str, float] = {}
+        self._next_id = 0
+
+    # The events come from the trace, so syncing only waits like an idle homeserver would
+    async def sync(self, since: Optional[str] = None, timeout: int = 30000, *_, **__) -> JSON:
+        await asyncio.sleep(timeout / 1000)
+        return {"next_batch": since or "replay"}
+
+    async def create_filter(self, *_, **__) -> FilterID:
+        return FilterID("replay")
+
+    def dispatch_event(self, evt: Event, source: SyncStream) -> List[asyncio.Task]:
+        self.apply_state(evt)
+        if isinstance(evt, MessageEvent):
+            evt = MaubotMessageEvent(evt, self)
+        else:
+            evt.client = self
+        token = _current_event.set(evt.event_id)
+        try:
+            return super().dispatch_event(evt, source)
+        finally:
+            _current_event.reset(token)
+
+    def dispatch_manual_event(self, event_type: Any, data: Any,
+                              include_global_handlers: bool = False,
+                              force_synchronous: bool = False) -> List[asyncio.Task]:
+        # Handler tasks inherit the context, so tasks created by the membership dispatcher are
+        # attributed to the original event too
+        tasks = super().dispatch_manual_event(event_type, data, include_global_handlers,
+                                              force_synchronous=True)
+        self.tasks += tasks
+        event_id = _current_event.get()
+        if event_id:
+            for task in tasks:
+                task.add_done_callback(lambda _: self.finished.__setitem__(event_id,
+                                                                           time.perf_counter()))
+        return tasks
+
+    def apply_state(self, evt: Event) -> None:
+        if evt.type == EventType.ROOM_MEMBER:
+            if evt.content.membership == Membership.INVITE and evt.state_key == self.mxid:
+                # The inviter is already in the room
+                self.members[evt.room_id][evt.sender] = Member(membership=Membership.JOIN)
+            elif evt.content.membership == Membership.JOIN:
+                self.members[evt.room_id][evt.state_key] = Member(
+                    membership=Membership.JOIN, displayname=evt.content.displayname,
+                    avatar_url=evt.content.avatar_url)
+            else:
+                self.members[evt.room_id].pop(evt.state_key, None)
+        elif evt.type == EventType.ROOM_NAME:
+            self.room_names[evt.room_id] = evt.content.name
+
+    async def _request(self, method: str) -> None:
+        self.calls[method] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+    def _event_id(self) -> str:
+        self._next_id += 1
+        # Unique across replay processes sharing a database
+        return f"$sent{os.getpid()}-{self._next_id}"
+
+    async def send_markdown(self, room_id: str, markdown: str, **kwargs: Any) -> str:
+        await self._request("send_markdown")
+        return self._event_id()
+
+    async def send_text(self, room_id: str, text: str, **kwargs: Any) -> str:
+        await self._request("send_text")
+        return self._event_id()
+
+    async def redact(self, room_id: str, event_id: str, reason: Optional[str] = None) -> str:
+        await self._request("redact")
+        return self._event_id()
+
+    async def invite_user(self, room_id: str, user_id: str, **kwargs: Any) -> None:
+        await self._request("invite_user")
+
+    async def join_room_by_id(self, room_id: str, **kwargs: Any) -> str:
+        await self._request("join_room_by_id")
+        self.members[room_id][self.mxid] = Member(membership=Membership.JOIN)
+        return room_id
+
+    async def get_joined_members(self, room_id: str) -> Dict[str, Member]:
+        await self._request("get_joined_members")
+        return dict(self.members[room_id])
+
+    async def get_state_event(self, room_id: str, event_type: EventType, state_key: str = ""
+                              ) -> Any:
+        await self._request("get_state_event")
+        if event_type == EventType.ROOM_NAME:
+            return RoomNameStateEventContent(name=self.room_names.get(room_id, ""))
+        member = self.members[room_id].get(state_key)
+        return MemberStateEventContent(membership=Membership.JOIN,
+                                       displayname=member.displayname if member else None)
+
+
+class TraceBuilder:
+    def __init__(self) -> None:
+        self.phases: List[Phase] = []
+        self.timestamp = int(time.time() * 1000)
+        self.counter = 0
+
+    def phase(self, name: str) -> None:
+        # Leave enough time between phases for the cooldowns in the config to pass
+        self.timestamp += 60 * 60 * 1000
+        self.phases.append((name, []))
+
+    def add(self, room_id: str, sender: str, event_type: str, content: Dict[str, Any],
+            **extra: Any) -> None:
+        self.counter += 1
+        self.timestamp += 1
+        self.phases[-1][1].append({"type": event_type, "room_id": room_id, "sender": sender,
+                                   "event_id": f"$trace{self.counter}",
+                                   "origin_server_ts": self.timestamp, "content": content,
+                                   **extra})
+
+    def member(self, room_id: str, sender: str, user_id: str, membership: Membership,
+               prev: Membership = Membership.LEAVE, **content: Any) -> None:
+        self.add(room_id, sender, "m.room.member", {"membership": membership.value, **content},
+                 state_key=user_id, unsigned={"prev_content": {"membership": prev.value}})
+
+    def message(self, room_id: str, sender: str, body: str) -> None:
+        self.add(room_id, sender, "m.room.message", {"msgtype": "m.text", "body": body})
+
+    def claim(self, case_id: str, agent: str) -> None:
+        self.add(CONTROL_ROOM, agent, "m.reaction", {"m.relates_to": {
+            "rel_type": "m.annotation", "event_id": f"$latest:{case_id}", "key": "\U0001F44D"}})
+
+
+def _case(i: int) -> Tuple[str, str]:
+    return f"!case{i}:bench", f"@customer{i}:bench"
+
+
+def _agent(i: int) -> str:
+    return f"@agent{i}:bench"
+
+
+def _open_cases(trace: TraceBuilder, args: argparse.Namespace) -> None:
+    trace.phase("agents join")
+    for i in range(args.agents):
+        trace.member(CONTROL_ROOM, _agent(i), _agent(i), Membership.JOIN,
+                     displayname=f"Agent {i}")
+    trace.phase("open cases")
+    for i in range(args.cases):
+        room_id, customer = _case(i)
+        trace.member(room_id, customer, BOT_MXID, Membership.INVITE, is_direct=True)
+
+
+def message_burst(args: argparse.Namespace) -> List[Phase]:
+    trace = TraceBuilder()
+    _open_cases(trace, args)
+    trace.phase("message burst")
+    for n in range(args.messages):
+        for i in range(args.cases):
+            room_id, customer = _case(i)
+            trace.message(room_id, customer, f"Message {n}")
+    trace.phase("claims")
+    for i in range(args.cases):
+        trace.claim(_case(i)[0], _agent(i % args.agents))
+    trace.phase("agents join cases")
+    for i in range(args.cases):
+        trace.member(_case(i)[0], _agent(i % args.agents), _agent(i % args.agents),
+                     Membership.JOIN, displayname=f"Agent {i % args.agents}")
+    trace.phase("agent messages")
+    for i in range(args.cases):
+        room_id, customer = _case(i)
+        trace.message(room_id, _agent(i % args.agents), "Hello, how can I help?")
+        trace.message(room_id, customer, "Thanks!")
+    trace.phase("customers leave")
+    for i in range(args.cases):
+        room_id, customer = _case(i)
+        trace.member(room_id, customer, customer, Membership.LEAVE, prev=Membership.JOIN)
+    return trace.phases
+
+
+def claim_storm(args: argparse.Namespace) -> List[Phase]:
+    trace = TraceBuilder()
+    _open_cases(trace, args)
+    trace.phase("claim storm")
+    for n in range(args.agents):
+        for i in range(args.cases):
+            trace.claim(_case(i)[0], _agent(n))
+    return trace.phases
+
+
+SCENARIOS: Dict[str, Callable[[argparse.Namespace], List[Phase]]] = {
+    "message-burst": message_burst,
+    "claim-storm": claim_storm,
+}
+
+
+def load_trace(path: str) -> List[Phase]:
+    phases: List[Phase] = []
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            data = json.loads(line)
+            if "phase" in data:
+                phases.append((data["phase"], []))
+            else:
+                if not phases:
+                    phases.append(("replay", []))
+                phases[-1][1].append(data)
+    return phases
+
+
+def save_trace(path: str, phases: List[Phase]) -> None:
+    with open(path, "w") as file:
+        for name, events in phases:
+            file.write(json.dumps({"phase": name}) + "\n")
+            for data in events:
+                file.write(json.dumps(data) + "\n")
+
+
+def make_config(overrides: List[str]) -> Config:
+    yaml = YAML()
+
+    def load() -> Dict[str, Any]:
+        with open(BASE_CONFIG) as file:
+            data = RecursiveDict(yaml.load(file), dict)
+        data["control_room"] = CONTROL_ROOM
+        # Status edits are normally delayed by a couple of seconds, which would dominate the
+        # duration of each phase
+        data["status_update_delay"] = 0.01
+        for override in overrides:
+            key, value = override.split("=", 1)
+            data[key] = yaml.load(value)
+        return data
+
+    def load_base() -> RecursiveDict:
+        with open(BASE_CONFIG) as file:
+            return RecursiveDict(yaml.load(file), dict)
+
+    return Config(load, load_base, lambda _: None)
+
+
+class Replay:
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.log = logging.getLogger("replay")
+        self.client = FakeClient(args.latency / 1000, self.log.getChild("client"))
+        self.client.members[CONTROL_ROOM][BOT_MXID] = Member(membership=Membership.JOIN)
+        url = args.database or "sqlite:///" + os.path.join(
+            tempfile.mkdtemp(prefix="supportportal-replay-"), "replay.db")
+        # Wait for other processes writing to the same SQLite file instead of failing
+        self.engine = create_engine(url, connect_args={"timeout": 60}
+                                    if url.startswith("sqlite") else {})
+        self.queries = 0
+        event.listen(self.engine, "before_cursor_execute", self._count_query)
+        self.bot = SupportPortalBot(client=self.client, loop=asyncio.get_event_loop(), http=None,
+                                    instance_id="replay", log=self.log.getChild("bot"),
+                                    config=make_config(args.set), database=self.engine,
+                                    webapp=None, webapp_url=None, loader=None)
+        self._submit_queued = self.bot.room_queues.submit
+        self.bot.room_queues.submit = self._track_queued
+
+    def _count_query(self, *_) -> None:
+        self.queries += 1
+
+    async def _track_queued(self, *args: Any, **kwargs: Any) -> asyncio.Future:
+        # Handlers only queue the event, so the event is finished once its queued job is
+        future = await self._submit_queued(*args, **kwargs)
+        event_id = _current_event.get()
+        if event_id:
+            finished = self.client.finished
+            future.add_done_callback(lambda _: finished.__setitem__(
+                event_id, max(finished.get(event_id, 0), time.perf_counter())))
+        return future
+
+    async def start(self) -> None:
+        await self.bot.internal_start()
+
+    async def stop(self) -> None:
+        await self.bot.stop()
+
+    async def _resolve(self, data: Dict[str, Any]) -> Event:
+        evt = Event.deserialize(data)
+        relates_to = getattr(evt.content, "relates_to", None)
+        if relates_to and relates_to.event_id and relates_to.event_id.startswith("$latest:"):
+            ctrl = await self.bot.control_event.latest_for_case(relates_to.event_id[8:])
+            relates_to.event_id = ctrl.event_id if ctrl else "$missing"
+        return evt
+
+    async def _drain(self) -> None:
+        while True:
+            pending = [task for task in self.client.tasks if not task.done()]
+            if pending:
+                await asyncio.gather(*pending)
+            elif self.bot.room_queues.workers:
+                await asyncio.gather(*self.bot.room_queues.workers.values())
+            elif self.bot.outbox.lanes or self.bot.status_updates:
+                await asyncio.sleep(0.001)
+            else:
+                # Status edits are sent from separate tasks after the timer fires
+                await asyncio.sleep(0.01)
+                if (not self.bot.outbox.lanes and not self.bot.status_updates
+                        and not self.bot.room_queues.workers):
+                    break
+        self.client.tasks = []
+
+    async def run_phase(self, name: str, events: List[Dict[str, Any]]) -> Dict[str, Any]:
+        resolved = [await self._resolve(data) for data in events]
+        self.client.calls.clear()
+        self.client.finished = finished = {}
+        self.queries = 0
+        dispatched: Dict[str, float] = {}
+        start = time.perf_counter()
+        for evt in resolved:
+            source = (SyncStream.INVITED_ROOM if evt.type == EventType.ROOM_MEMBER
+                      and evt.content.membership == Membership.INVITE
+                      and evt.state_key == BOT_MXID else SyncStream.JOINED_ROOM)
+            dispatched[evt.event_id] = time.perf_counter()
+            self.client.dispatch_event(evt, source | SyncStream.TIMELINE)
+            if self.args.rate:
+                await asyncio.sleep(1 / self.args.rate)
+        await self._drain()
+        duration = time.perf_counter() - start
+
+        latencies = sorted(finished.get(event_id, started) - started
+                           for event_id, started in dispatched.items())
+        count = len(events) or 1
+        return {
+            "phase": name,
+            "events": len(events),
+            "duration": duration,
+            "events_per_second": len(events) / duration if duration else 0,
+            "latency_p50": latencies[len(latencies) // 2] if latencies else 0,
+            "latency_p99": latencies[int(len(latencies) * 0.99)] if latencies else 0,
+            "db_queries_per_event": self.queries / count,
+            "api_calls_per_event": sum(self.client.calls.values()) / count,
+            "api_calls": dict(self.client.calls),
+        }
+
+
+def arrive(directory: str, phase: int) -> None:
+    os.makedirs(directory, exist_ok=True)
+    open(os.path.join(directory, f"{phase}-{os.getpid()}"), "w").close()
+
+
+async def wait_for_instances(directory: str, phase: int, instances: int) -> None:
+    prefix = f"{phase}-"
+    while sum(name.startswith(prefix) for name in os.listdir(directory)) < instances:
+        await asyncio.sleep(0.01)
+
+
+def claim_leave(directory: str) -> bool:
+    try:
+        os.close(os.open(os.path.join(directory, "leaving"), os.O_CREAT | os.O_EXCL))
+        return True
+    except FileExistsError:
+        return False
+
+
+def report(result: Dict[str, Any]) -> None:
+    print(f"{result['phase']:>20}: {result['events']:6d} events in "
+          f"{result['duration'] * 1000:8.1f} ms, {result['events_per_second']:8.1f} events/s, "
+          f"p50 {result['latency_p50'] * 1000:7.1f} ms, p99 {result['latency_p99'] * 1000:7.1f} ms, "
+          f"{result['db_queries_per_event']:5.2f} queries/event, "
+          f"{result['api_calls_per_event']:5.2f} API calls/event")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay event traces through the plugin")
+    parser.add_argument("scenario", nargs="?", default="message-burst", choices=SCENARIOS,
+                        help="Synthetic scenario to generate")
+    parser.add_argument("--cases", type=int, default=1000, help="Number of cases to open")
+    parser.add_argument("--agents", type=int, default=50, help="Number of agents")
+    parser.add_argument("--messages", type=int, default=5,
+                        help="Messages per case in the message burst")
+    parser.add_argument("--latency", type=float, default=5, help="Fake API latency (ms)")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Events per second to dispatch (default: all at once)")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Override a config option, e.g. --set cache.cases=100")
+    parser.add_argument("--trace", help="Replay a JSONL trace instead of a scenario")
+    parser.add_argument("--save-trace", help="Write the generated trace to a JSONL file")
+    parser.add_argument("--json", action="store_true", help="Print the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="Log plugin output")
+    parser.add_argument("--database", help="SQLAlchemy URL of the database to use "
+                                           "(default: a new SQLite database)")
+    parser.add_argument("--barrier", metavar="DIR",
+                        help="Directory used to wait for the other replay processes")
+    parser.add_argument("--instances", type=int, default=1,
+                        help="Number of replay processes waiting at the barrier")
+    parser.add_argument("--leave-after", type=int, metavar="PHASE",
+                        help="Stop after the given phase (counting from 0) if no other process "
+                             "at the barrier has left yet and this one holds leases")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.ERROR)
+
+    phases = load_trace(args.trace) if args.trace else SCENARIOS[args.scenario](args)
+    if args.save_trace:
+        save_trace(args.save_trace, phases)
+
+    replay = Replay(args)
+    await replay.start()
+    results = []
+    left = False
+    try:
+        for index, (name, events) in enumerate(phases):
+            if args.barrier:
+                arrive(args.barrier, index)
+                await wait_for_instances(args.barrier, index, args.instances)
+                # Pick up the changes that the other instances made in the previous phase
+                if replay.bot.coordinator.enabled:
+                    await replay.bot.coordinator.poll()
+            result = await replay.run_phase(name, events)
+            results.append(result)
+            if not args.json:
+                report(result)
+            if (args.barrier and index == args.leave_after and replay.bot.coordinator.owned
+                    and claim_leave(args.barrier)):
+                # The other processes would handle the events of this phase again if they took
+                # over its rooms before finishing it. They can continue once the leases have been
+                # released.
+                await wait_for_instances(args.barrier, index + 1, args.instances - 1)
+                await replay.stop()
+                left = True
+                for later in range(index + 1, len(phases)):
+                    arrive(args.barrier, later)
+                break
+    finally:
+        if not left:
+            await replay.stop()
+    if args.json:
+        print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    asyncio.get_event_loop().run_until_complete(main())
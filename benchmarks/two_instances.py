@@ -0,0 +1,141 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+"""Check that several instances sharing a database behave like a single instance.
+
+The same trace is replayed once by a single instance and once by several replay processes that
+share a database with coordination enabled. Every process receives every event, like bots
+syncing the same account would. The processes should split the rooms between them, so the
+actions that must happen exactly once (joining case rooms, inviting agents and the rows written
+to the database) are compared with the single instance. The API calls of each phase are shown
+for each process. With ``--handover``, one of the processes stops after the given phase and the
+others take over its rooms.
+
+Usage: python -m benchmarks.two_instances [SCENARIO] [--cases N] [--agents N] [--messages N]
+                                          [--latency MS] [--rate N] [--instances N]
+                                          [--handover PHASE] [--database URL]
+"""
+from typing import Any, Dict, List
+from collections import Counter
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from sqlalchemy import create_engine
+
+from .replay import SCENARIOS, save_trace
+
+# API calls that a single instance makes exactly once per case, agent or claim
+EXACT_CALLS = ("join_room_by_id", "invite_user")
+TABLES = ("case", "control_event", "case_accept", "agent")
+
+
+def replay(args: argparse.Namespace, trace: str, database: str, *extra: str) -> subprocess.Popen:
+    return subprocess.Popen([sys.executable, "-m", "benchmarks.replay", "--trace", trace,
+                             "--latency", str(args.latency), "--rate", str(args.rate),
+                             "--database", database, "--json",
+                             *extra], stdout=subprocess.PIPE)
+
+
+def results(process: subprocess.Popen) -> List[Dict[str, Any]]:
+    output, _ = process.communicate()
+    if process.returncode != 0:
+        raise SystemExit(f"Replay process failed with exit code {process.returncode}")
+    return json.loads(output)
+
+
+def count_rows(database: str) -> Dict[str, int]:
+    engine = create_engine(database)
+    try:
+        return {table: engine.execute(f'SELECT COUNT(*) FROM "{table}"').scalar()
+                for table in TABLES}
+    finally:
+        engine.dispose()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Compare instances sharing a database with a "
+                                                 "single instance")
+    parser.add_argument("scenario", nargs="?", default="message-burst", choices=SCENARIOS,
+                        help="Synthetic scenario to generate")
+    parser.add_argument("--cases", type=int, default=200, help="Number of cases to open")
+    parser.add_argument("--agents", type=int, default=20, help="Number of agents")
+    parser.add_argument("--messages", type=int, default=3,
+                        help="Messages per case in the message burst")
+    parser.add_argument("--latency", type=float, default=5, help="Fake API latency (ms)")
+    parser.add_argument("--rate", type=float, default=0,
+                        help="Events per second to dispatch (default: all at once)")
+    parser.add_argument("--instances", type=int, default=2, help="Number of instances")
+    parser.add_argument("--handover", type=int, metavar="PHASE",
+                        help="Stop the instance holding leases after the given phase (counting "
+                             "from 0)")
+    parser.add_argument("--database", help="SQLAlchemy URL of an empty database for the "
+                                           "instances to share (default: a new SQLite file)")
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="supportportal-instances-")
+    trace = os.path.join(directory, "trace.jsonl")
+    save_trace(trace, SCENARIOS[args.scenario](args))
+    empty_trace = os.path.join(directory, "empty.jsonl")
+    open(empty_trace, "w").close()
+
+    baseline_db = f"sqlite:///{os.path.join(directory, 'single.db')}"
+    baseline = results(replay(args, trace, baseline_db))
+
+    shared_db = args.database or f"sqlite:///{os.path.join(directory, 'shared.db')}"
+    # Create the tables first, so the instances don't race to create them
+    results(replay(args, empty_trace, shared_db))
+    extra = ["--barrier", os.path.join(directory, "barrier"), "--instances", str(args.instances),
+             "--set", "coordination.enabled=true", "--set", "coordination.poll_interval=0.1"]
+    if args.handover is not None:
+        extra += ["--leave-after", str(args.handover)]
+    processes = [replay(args, trace, shared_db, *extra) for _ in range(args.instances)]
+    instances = [results(process) for process in processes]
+
+    ok = True
+    for index, single in enumerate(baseline):
+        # An instance that left doesn't have results for the later phases
+        calls = [instance[index]["api_calls"] if index < len(instance) else {}
+                 for instance in instances]
+        total = sum((Counter(instance_calls) for instance_calls in calls), Counter())
+        print(f"{single['phase']}:")
+        print(f"  {'single instance':>17}: {sum(single['api_calls'].values()):6d} API calls "
+              f"{dict(sorted(single['api_calls'].items()))}")
+        for number, instance_calls in enumerate(calls, 1):
+            print(f"  {f'instance {number}':>17}: {sum(instance_calls.values()):6d} API calls "
+                  f"{dict(sorted(instance_calls.items()))}")
+        for method in EXACT_CALLS:
+            if total[method] != single["api_calls"].get(method, 0):
+                print(f"  MISMATCH: {total[method]} {method} calls by the instances, "
+                      f"{single['api_calls'].get(method, 0)} by a single instance")
+                ok = False
+
+    single_rows = count_rows(baseline_db)
+    shared_rows = count_rows(shared_db)
+    print("database rows:")
+    for table in TABLES:
+        match = single_rows[table] == shared_rows[table]
+        ok = ok and match
+        print(f"  {table:>17}: {shared_rows[table]:6d} shared, {single_rows[table]:6d} single "
+              f"instance{'' if match else '  MISMATCH'}")
+    print("OK" if ok else "FAILED")
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,96 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Set, Iterable, Iterator, Type
+
+from mautrix.types import RoomID, UserID
+
+from .db import Agent
+
+
+class AgentRoster:
+    # The agents of each control room, persisted in the agent table. Membership checks and
+    # iteration operate on the agents of all control rooms combined.
+    table: Type[Agent]
+    rooms: Dict[RoomID, Set[UserID]]
+    _all: Set[UserID]
+
+    def __init__(self, table: Type[Agent]) -> None:
+        self.table = table
+        self.rooms = {}
+        self._all = set()
+
+    def __contains__(self, user_id: UserID) -> bool:
+        return user_id in self._all
+
+    def __iter__(self) -> Iterator[UserID]:
+        return iter(self._all)
+
+    def __len__(self) -> int:
+        return len(self._all)
+
+    def in_room(self, room_id: RoomID) -> Set[UserID]:
+        return self.rooms.get(room_id, set())
+
+    def has_room(self, room_id: RoomID) -> bool:
+        return bool(self.rooms.get(room_id))
+
+    def _recalculate(self) -> None:
+        self._all = set().union(*self.rooms.values())
+
+    async def load(self) -> None:
+        self.rooms = {}
+        for agent in await self.table.all():
+            self.rooms.setdefault(agent.room_id, set()).add(agent.user_id)
+        self._recalculate()
+
+    async def add(self, room_id: RoomID, user_id: UserID) -> None:
+        agents = self.rooms.setdefault(room_id, set())
+        if user_id in agents:
+            return
+        agents.add(user_id)
+        self._all.add(user_id)
+        await self.table(room_id=room_id, user_id=user_id).insert()
+
+    async def remove(self, room_id: RoomID, user_id: UserID) -> None:
+        try:
+            self.rooms[room_id].remove(user_id)
+        except KeyError:
+            return
+        if not any(user_id in agents for agents in self.rooms.values()):
+            self._all.discard(user_id)
+        await self.table(room_id=room_id, user_id=user_id).delete()
+
+    async def replace_room(self, room_id: RoomID, user_ids: Iterable[UserID]) -> None:
+        user_ids = set(user_ids)
+        if self.rooms.get(room_id) == user_ids:
+            return
+        self.rooms[room_id] = user_ids
+        self._recalculate()
+        await self.table.replace_room(room_id, user_ids)
+
+    async def reload_room(self, room_id: RoomID) -> None:
+        # Picks up changes made by another instance
+        user_ids = {agent.user_id for agent in await self.table.all_in_room(room_id)}
+        if user_ids:
+            self.rooms[room_id] = user_ids
+        else:
+            self.rooms.pop(room_id, None)
+        self._recalculate()
+
+    async def drop_room(self, room_id: RoomID) -> None:
+        if self.rooms.pop(room_id, None) is not None:
+            self._recalculate()
+        await self.table.replace_room(room_id, set())
@@ -13,25 +13,41 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Type, Tuple, Dict, Optional, Set, Union
-from collections import defaultdict
+from typing import Type, Tuple, Dict, List, Set, Optional, Union, Hashable
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from urllib.parse import quote
+from uuid import uuid4
 from time import time
 import asyncio
+import hmac
 
-from jinja2 import Environment as JinjaEnvironment
+from aiohttp.web import Request, Response, StreamResponse
 from sqlalchemy.ext.declarative import declarative_base
 
 from mautrix.types import (EventType, StateEvent, ReactionEvent, MessageEvent, RedactionEvent,
-                           RoomID, UserID, Member, RelationType)
+                           RoomID, UserID, EventID, Member, Membership, RelationType)
 from mautrix.client import InternalEventType, MembershipEventDispatcher, SyncStream
 from mautrix.util.db import BaseClass
 
 from maubot import Plugin
-from maubot.handlers import event, command
+from maubot.handlers import event, command, web
 
-from .db import Case, ControlEvent, CaseAccept
-from .config import Config, ConfigTemplateLoader
-from .util import with_case, ignore_control_bot, lock_room
+from .db import (Case, CaseState, ControlEvent, CaseAccept, Agent, ArchivedCase, Lease,
+                 Invalidation, Version)
+from .agents import AgentRoster
+from .migrations import upgrade
+from .config import Config, TemplateManager
+from .coordination import Coordinator
+from .cache import LRUCache
+from .metrics import Metrics, InstrumentedClient
+from .outbox import Outbox, Priority
+from .roomqueue import RoomQueues
+from .writeback import CaseWriter
+from .router import CaseRouter
+from .scheduler import Scheduler
+from .transcript import TranscriptStore
+from .util import with_case, ignore_control_bot, queued, timed_handler
 
 CLAIM_EMOJI = r"(?:\U0001F44D[\U0001F3FB-\U0001F3FF]?)"
 
@@ -40,100 +56,451 @@ def now_ms() -> int:
     return int(time() * 1000)
 
 
+async def _noop() -> None:
+    return None
+
+
 class SupportPortalBot(Plugin):
     config: Config
 
     control_room: RoomID
-    jinja_env: JinjaEnvironment
+    router: CaseRouter
+    templates: TemplateManager
     config_load_id: int
 
     case: Type[Case]
     control_event: Type[ControlEvent]
     case_accept: Type[CaseAccept]
+    agent: Type[Agent]
+    archived_case: Type[ArchivedCase]
+    lease: Type[Lease]
+    invalidation: Type[Invalidation]
+    version: Type[Version]
+    db_executor: Optional[ThreadPoolExecutor]
+    metrics: Metrics
+    outbox: Outbox
+    room_queues: RoomQueues
+    reminders: Scheduler
+    transcripts: TranscriptStore
+    case_writer: Optional[CaseWriter]
+    coordinator: Coordinator
 
-    cases: Dict[RoomID, Case]
-    locks: Dict[RoomID, asyncio.Lock]
-    room_members: Dict[RoomID, Dict[UserID, Member]]
-    agents: Set[UserID]
-    enabled_templates: Dict[str, bool]
+    cases: LRUCache[RoomID, Case]
+    latest_ctrl: LRUCache[RoomID, Optional[ControlEvent]]
+    ctrl_cases: LRUCache[EventID, RoomID]
+    status_updates: Dict[RoomID, asyncio.TimerHandle]
+    last_control_edit: LRUCache[RoomID, Tuple[int, str]]
+    non_cases: LRUCache[RoomID, bool]
+    room_members: LRUCache[RoomID, Dict[UserID, Member]]
+    agents: AgentRoster
 
     new_message_cooldown: int
     new_user_cooldown: int
+    reminder_after: int
+    reminder_repeat: int
+    status_update_delay: float
+    warmup_task: Optional[asyncio.Future]
+    agent_resync_task: Optional[asyncio.Future]
+    maintenance_task: Optional[asyncio.Future]
 
     def __init__(self, *args, **kwargs) -> None:
         super().__init__(*args, **kwargs)
+        self.metrics = Metrics()
+        self.metrics.collectors.append(self._collect_metrics)
+        self.client = InstrumentedClient(self.client, self.metrics)
+        self.outbox = Outbox(self.loop, self.log, self.metrics)
+        self.room_queues = RoomQueues(self.loop, self.log, self.metrics)
+        self.reminders = Scheduler(self.loop, self.log, self.send_reminders)
+        self.transcripts = TranscriptStore(self.loop, self.log)
+        self.coordinator = Coordinator(self.loop, self.log, f"{self.id}/{uuid4().hex}")
+        self.coordinator.on_acquired = self.on_room_acquired
+        self.coordinator.on_lost = self.on_room_lost
+        self.coordinator.on_invalidated = self.on_invalidated
+        self.control_room = None
+        self.router = CaseRouter()
 
-        self.agents = set()
-
-        self.room_members = {}
-        self.cases = {}
-        self.enabled_templates = {}
-        self.locks = defaultdict(lambda: asyncio.Lock())
+        self.room_members = LRUCache("room_members", 0)
+        self.cases = LRUCache("cases", 0)
+        self.latest_ctrl = LRUCache("control_events", 0)
+        self.ctrl_cases = LRUCache("control_event_cases", 0)
+        self.status_updates = {}
+        self.last_control_edit = LRUCache("control_edits", 0)
+        self.non_cases = LRUCache("non_case_rooms", 0)
+        self.warmup_task = None
+        self.agent_resync_task = None
+        self.maintenance_task = None
+        self.db_executor = None
+        self.case_writer = None
 
     async def start(self) -> None:
         self.client.add_dispatcher(MembershipEventDispatcher)
 
         self.config.load_and_update()
         self.load_simple_vars()
+        self.outbox.start()
+        self.transcripts.start()
 
-        loader = ConfigTemplateLoader(self.config)
-        self.jinja_env = JinjaEnvironment(loader=loader)
+        self.templates = TemplateManager(self.config, self.log)
+        if self.config["precompile_templates"]:
+            self.templates.precompile({})
 
         base = declarative_base(cls=BaseClass, bind=self.database)
         self.case = Case.copy(bind=self.database, rebase=base)
         self.control_event = ControlEvent.copy(bind=self.database, rebase=base)
         self.case_accept = CaseAccept.copy(bind=self.database, rebase=base)
-        base.metadata.create_all()
+        self.agent = Agent.copy(bind=self.database, rebase=base)
+        self.archived_case = ArchivedCase.copy(bind=self.database, rebase=base)
+        self.lease = Lease.copy(bind=self.database, rebase=base)
+        self.invalidation = Invalidation.copy(bind=self.database, rebase=base)
+        self.version = Version.copy(bind=self.database, rebase=base)
+        self.case_writer = CaseWriter(self.case, self.loop, self.log)
+        self.load_write_behind_config()
+
+        # SQLite doesn't handle concurrent writers, so only use multiple threads for real databases
+        db_threads = (1 if self.database.dialect.name == "sqlite"
+                      else self.config["database_threads"])
+        self.db_executor = ThreadPoolExecutor(max_workers=db_threads,
+                                              thread_name_prefix="supportportal-db")
+        for table in (self.case, self.control_event, self.case_accept, self.agent,
+                      self.archived_case, self.lease, self.invalidation, self.version):
+            table.executor = self.db_executor
+            table.metrics = self.metrics
+        await self.loop.run_in_executor(self.db_executor, upgrade, self.database, base.metadata,
+                                        self.version, self.log)
+        await self.coordinator.start(self.lease, self.invalidation)
+        self.case_writer.start()
+        self.router.set_load(await self.case.count_active_by_control_room())
+        await self.load_reminders()
+        self.reminders.start()
 
+        self.agents = AgentRoster(self.agent)
+        await self.agents.load()
         await self.update_agents()
+        self.agent_resync_task = asyncio.ensure_future(self._resync_agents_loop(), loop=self.loop)
+        self.maintenance_task = asyncio.ensure_future(self._maintenance_loop(), loop=self.loop)
+        if self.config["warmup.enabled"]:
+            self.warmup_task = asyncio.ensure_future(self.warm_up(), loop=self.loop)
+
+    async def stop(self) -> None:
+        if self.warmup_task:
+            self.warmup_task.cancel()
+        if self.agent_resync_task:
+            self.agent_resync_task.cancel()
+        if self.maintenance_task:
+            self.maintenance_task.cancel()
+        for handle in self.status_updates.values():
+            handle.cancel()
+        self.status_updates = {}
+        await self.reminders.stop()
+        await self.room_queues.stop()
+        await self.transcripts.stop()
+        await self.outbox.stop()
+        # The writer and executor don't exist yet if start() failed before creating them
+        if self.case_writer:
+            await self.case_writer.stop()
+        await self.coordinator.stop()
+        if self.db_executor:
+            await self.loop.run_in_executor(None, self.db_executor.shutdown)
 
     def load_simple_vars(self) -> None:
         self.new_user_cooldown = self.config["new_user_cooldown"] * 1000
         self.new_message_cooldown = self.config["new_message_cooldown"] * 1000
+        self.reminder_after = self.config["reminders.after"] * 1000
+        self.reminder_repeat = self.config["reminders.repeat"] * 1000
+        self.reminders.configure(self.config["reminders.batch_size"])
+        self.status_update_delay = self.config["status_update_delay"]
         self.control_room = self.config["control_room"]
+        self.router.configure(self.control_room, self.config["routing"])
+        self.room_queues.configure(self.config["room_queues.concurrency"],
+                                   self.config["room_queues.max_depth"])
+        self.outbox.configure(self.config["outbox.concurrency"], self.config["outbox.max_retries"])
+        coordination = self.config["coordination"]
+        self.coordinator.configure(coordination["enabled"], coordination["lease_ttl"],
+                                   coordination["heartbeat_interval"],
+                                   coordination["poll_interval"])
+        transcripts = self.config["transcripts"]
+        self.transcripts.configure(transcripts["directory"], transcripts["max_file_size"],
+                                   transcripts["flush_interval"], transcripts["max_buffered"])
+
+        cache = self.config["cache"]
+        self.cases.configure(cache["cases"])
+        self.latest_ctrl.configure(cache["cases"])
+        self.ctrl_cases.configure(cache["cases"])
+        self.last_control_edit.configure(cache["cases"])
+        self.non_cases.configure(cache["non_case_rooms"])
+        self.room_members.configure(cache["room_members"], ttl=cache["room_members_ttl"])
+
+    def load_write_behind_config(self) -> None:
+        self.case_writer.configure(self.config["write_behind.interval"],
+                                   self.config["write_behind.max_pending"],
+                                   self.config["write_behind.write_through"])
+
+    @property
+    def caches(self) -> Tuple[LRUCache, ...]:
+        return (self.cases, self.latest_ctrl, self.ctrl_cases, self.last_control_edit,
+                self.non_cases, self.room_members)
 
     def on_external_config_update(self) -> None:
+        prev_control_rooms = self.control_rooms
         self.config.load_and_update()
         self.load_simple_vars()
-        self.jinja_env.loader.reload()
-        self.enabled_templates = {}
-        asyncio.ensure_future(self.update_agents(), loop=self.loop)
+        self.load_write_behind_config()
+        self.templates.reload()
+        if self.control_rooms != prev_control_rooms:
+            asyncio.ensure_future(self.update_agents(), loop=self.loop)
+
+    @property
+    def control_rooms(self) -> List[RoomID]:
+        return self.router.control_rooms
+
+    def case_control_room(self, case: Case) -> RoomID:
+        return case.control_room or self.control_room
+
+    def case_agents(self, case: Case) -> Set[UserID]:
+        return self.agents.in_room(self.case_control_room(case))
+
+    async def update_agents(self, resync: bool = False) -> None:
+        for room_id in set(self.agents.rooms) - set(self.control_rooms):
+            await self.agents.drop_room(room_id)
+        await asyncio.gather(*(self.sync_agents(room_id) for room_id in self.control_rooms
+                               if resync or not self.agents.has_room(room_id)))
+
+    async def sync_agents(self, room_id: RoomID) -> None:
+        # The other instances read the agents that the owner of the control room saved
+        if not await self.coordinator.owns(room_id):
+            await self.agents.reload_room(room_id)
+            return
+        try:
+            members = await self.client.get_joined_members(room_id)
+        except Exception as e:
+            self.log.warning(f"Failed to get agents in control room {room_id}: {e}")
+            return
+        await self.agents.replace_room(room_id, (user_id for user_id in members.keys()
+                                                 if user_id != self.client.mxid))
+        await self.coordinator.publish(f"agents:{room_id}")
+
+    async def _resync_agents_loop(self) -> None:
+        while self.config["agent_resync_interval"] > 0:
+            await asyncio.sleep(self.config["agent_resync_interval"])
+            try:
+                await self.update_agents(resync=True)
+            except Exception:
+                self.log.exception("Failed to resync agents")
+
+    async def _maintenance_loop(self) -> None:
+        while self.config["lifecycle.interval"] > 0:
+            await asyncio.sleep(self.config["lifecycle.interval"])
+            try:
+                await self.run_maintenance()
+            except Exception:
+                self.log.exception("Failed to clean up old cases")
+
+    async def run_maintenance(self) -> None:
+        if not await self.coordinator.owns("maintenance"):
+            return
+        lifecycle = self.config["lifecycle"]
+        batch_size = lifecycle["batch_size"]
+        pruned = archived = 0
+        before = now_ms() - lifecycle["prune_control_events_after"] * 1000
+        while True:
+            event_ids = await self.control_event.prune_superseded(before, batch_size)
+            for event_id in event_ids:
+                self.ctrl_cases.pop(event_id, None)
+            pruned += len(event_ids)
+            if len(event_ids) < batch_size:
+                break
+        # Closing a case may still be waiting to be written
+        await self.case_writer.flush()
+        before = now_ms() - lifecycle["archive_after"] * 1000
+        while True:
+            room_ids = await self.case.archive_closed(before, batch_size)
+            for room_id in room_ids:
+                self.forget_case(room_id)
+            await self.coordinator.release(*room_ids)
+            await self.coordinator.publish(*(f"case:{room_id}" for room_id in room_ids))
+            archived += len(room_ids)
+            if len(room_ids) < batch_size:
+                break
+        if pruned or archived:
+            self.log.info(f"Pruned {pruned} old control events and archived {archived} cases")
+
+    def forget_case(self, room_id: RoomID) -> None:
+        self.cases.pop(room_id, None)
+        ctrl = self.latest_ctrl.pop(room_id, None)
+        if ctrl:
+            self.ctrl_cases.pop(ctrl.event_id, None)
+        self.last_control_edit.pop(room_id, None)
+        self.room_members.pop(room_id, None)
+        try:
+            self.status_updates.pop(room_id).cancel()
+        except KeyError:
+            pass
+        self.case_writer.forget(room_id)
+        self.reminders.cancel(room_id)
+
+    async def on_room_acquired(self, room_id: str) -> None:
+        # Whatever was cached while another instance handled the room may be outdated
+        self.forget_case(RoomID(room_id))
+        self.non_cases.pop(room_id, None)
+        if room_id in self.control_rooms:
+            await self.agents.reload_room(RoomID(room_id))
+
+    async def on_room_lost(self, room_id: str) -> None:
+        await self.case_writer.flush()
+        self.forget_case(RoomID(room_id))
+
+    async def on_invalidated(self, key: str) -> None:
+        kind, _, room_id = key.partition(":")
+        if kind == "agents":
+            await self.agents.reload_room(RoomID(room_id))
+        elif kind == "case":
+            self.forget_case(RoomID(room_id))
+            self.non_cases.pop(room_id, None)
+            await self.coordinator.release(room_id)
+
+    async def warm_up(self) -> None:
+        start = self.loop.time()
+        semaphore = asyncio.Semaphore(self.config["warmup.concurrency"])
+        cases = await self.case.all_recent(self.cases.max_size)
+        if self.coordinator.enabled:
+            # Rooms leased to other instances are handled there, so only the cases that this
+            # instance can lease are loaded
+            async def owns(room_id: RoomID) -> bool:
+                async with semaphore:
+                    return await self.coordinator.owns(room_id)
 
-    async def update_agents(self) -> None:
-        if self.control_room:
-            self.agents = set((await self.client.get_joined_members(self.control_room)).keys())
-            self.agents.remove(self.client.mxid)
+            owned = await asyncio.gather(*(owns(case.id) for case in cases))
+            cases = [case for case, is_owned in zip(cases, owned) if is_owned]
+        latest_ctrls = await self.control_event.latest_for_cases(case.id for case in cases)
+        # Insert least recently active cases first so they're the first ones to be evicted.
+        # Anything that was already loaded by an event handler is newer, so it's kept as-is.
+        for case in reversed(cases):
+            if case.id not in self.cases:
+                self.cases[case.id] = case
+            if case.id not in self.latest_ctrl:
+                ctrl = self.latest_ctrl[case.id] = latest_ctrls.get(case.id)
+                if ctrl:
+                    self.ctrl_cases[ctrl.event_id] = case.id
+        db_done = self.loop.time()
+
+        async def fetch_members(room_id: RoomID) -> bool:
+            async with semaphore:
+                try:
+                    await self.get_room_members(room_id)
+                    return True
+                except Exception as e:
+                    self.log.warning(f"Failed to get members of {room_id} during warmup: {e}")
+                    return False
+
+        results = await asyncio.gather(*(fetch_members(case.id)
+                                         for case in cases[:self.room_members.max_size]))
+        end = self.loop.time()
+        self.log.info(f"Warmed up {len(cases)} cases with {len(latest_ctrls)} control events in "
+                      f"{db_done - start:.2f} seconds and {sum(results)} member lists in "
+                      f"{end - db_done:.2f} seconds")
 
     @classmethod
     def get_config_class(cls) -> Type[Config]:
         return Config
 
     def template_enabled(self, name: str) -> bool:
-        try:
-            return self.enabled_templates[name]
-        except KeyError:
-            ok = self.enabled_templates[name] = bool(self.config["templates"][name])
-            return ok
+        return self.templates.is_enabled(name)
 
     def render(self, template: str, **kwargs) -> str:
-        return self.jinja_env.get_template(template).render(**kwargs)
+        return self.templates.render(template, **kwargs)
 
-    def get_case(self, room_id: RoomID) -> Optional[Case]:
+    async def get_case(self, room_id: RoomID) -> Optional[Case]:
+        if room_id in self.control_rooms:
+            return None
         try:
             return self.cases[room_id]
         except KeyError:
-            case = self.case.get(room_id)
-            if case:
-                self.cases[case.id] = case
-                return case
+            pass
+        if self.non_cases.get(room_id):
+            return None
+        case = self.case_writer.get(room_id) or await self.case.get(room_id)
+        if case:
+            self.cases[case.id] = case
+            return case
+        self.non_cases[room_id] = True
         return None
 
+    async def get_latest_control_event(self, room_id: RoomID) -> Optional[ControlEvent]:
+        try:
+            return self.latest_ctrl[room_id]
+        except KeyError:
+            ctrl = self.latest_ctrl[room_id] = await self.control_event.latest_for_case(room_id)
+            if ctrl:
+                self.ctrl_cases[ctrl.event_id] = room_id
+            return ctrl
+
+    async def get_control_event(self, event_id: EventID) -> Optional[ControlEvent]:
+        try:
+            room_id = self.ctrl_cases[event_id]
+        except KeyError:
+            ctrl = await self.control_event.get(event_id)
+            # Misses aren't cached, as a claim can arrive before its control event is saved
+            if ctrl:
+                self.ctrl_cases[event_id] = ctrl.case
+            return ctrl
+        latest = self.latest_ctrl.peek(room_id)
+        if latest and latest.event_id == event_id:
+            return latest
+        return await self.control_event.get(event_id)
+
+    def send_control_event(self, case: Case, markdown: str, index: int = 0) -> ControlEvent:
+        # The notice is sent in the background, so the room's queue isn't held up while the
+        # outbox is rate limited. The event ID is filled in once it's sent. Edits and redactions
+        # go through the same lane, so they're sent after the notice and can read the ID then.
+        ctrl = self.control_event(event_id=None, timestamp=now_ms(), case=case.id, index=index)
+        self.latest_ctrl[case.id] = ctrl
+        # A pending status update would be rendered over the new notice instead of the old one
+        self.cancel_status_update(case)
+
+        def forget_failed_notice(future: asyncio.Future) -> None:
+            if ((future.cancelled() or future.exception())
+                    and self.latest_ctrl.peek(case.id) is ctrl):
+                self.latest_ctrl.pop(case.id, None)
+
+        self.outbox.submit(partial(self._send_control_event, self.case_control_room(case), ctrl,
+                                   markdown),
+                           lane=self.control_lane(case), description=f"send notice for {case.id}"
+                           ).add_done_callback(forget_failed_notice)
+        return ctrl
+
+    async def _send_control_event(self, room_id: RoomID, ctrl: ControlEvent, markdown: str
+                                  ) -> EventID:
+        ctrl.event_id = await self.client.send_markdown(room_id, markdown)
+        self.ctrl_cases[ctrl.event_id] = ctrl.case
+        try:
+            await ctrl.insert()
+        except Exception:
+            self.log.exception(f"Failed to save control event of {ctrl.case}")
+        return ctrl.event_id
+
+    async def _edit_control_event(self, room_id: RoomID, ctrl: ControlEvent, markdown: str
+                                  ) -> Optional[EventID]:
+        # The control event wasn't sent if it doesn't have an ID by the time the edit is sent
+        if not ctrl.event_id:
+            return None
+        return await self.client.send_markdown(room_id, markdown, edits=ctrl.event_id)
+
+    async def _redact_control_event(self, room_id: RoomID, ctrl: ControlEvent, reason: str
+                                    ) -> Optional[EventID]:
+        if not ctrl.event_id:
+            return None
+        return await self.client.redact(room_id, ctrl.event_id, reason)
+
     async def get_room_members(self, room_id: RoomID) -> Dict[UserID, Member]:
         try:
             return self.room_members[room_id]
         except KeyError:
-            self.room_members[room_id] = await self.client.get_joined_members(room_id)
-            return self.room_members[room_id]
+            members = self.room_members[room_id] = await self.client.get_joined_members(room_id)
+            return members
+
+    async def _get_displayname(self, room_id: RoomID, user_id: UserID) -> Optional[str]:
+        member = await self.client.get_state_event(room_id, EventType.ROOM_MEMBER, user_id)
+        return member.displayname
 
     async def _get_room_name(self, room_id: RoomID) -> str:
         try:
@@ -143,7 +510,8 @@ class SupportPortalBot(Plugin):
             return ""
 
     @event.on(InternalEventType.INVITE)
-    @lock_room
+    @queued
+    @timed_handler
     async def self_invite_handler(self, evt: StateEvent) -> None:
         if evt.state_key != self.client.mxid or not evt.source & SyncStream.INVITED_ROOM:
             return
@@ -151,132 +519,305 @@ class SupportPortalBot(Plugin):
             await self.client.join_room_by_id(evt.room_id)
             await self.client.send_text(evt.room_id, "Room registered as the control room")
             self.control_room = self.config["control_room"] = evt.room_id
+            self.router.set_default(evt.room_id)
             await self.update_agents()
             self.config.save()
             return
+        elif evt.room_id in self.control_rooms:
+            await self.client.join_room_by_id(evt.room_id)
+            await self.sync_agents(evt.room_id)
+            return
 
         try:
             await self.client.join_room_by_id(evt.room_id)
-            displayname = None
-            if evt.content.is_direct:
-                member = await self.client.get_state_event(evt.room_id, EventType.ROOM_MEMBER,
-                                                           evt.sender)
-                displayname = member.displayname
-            case = self.case(id=evt.room_id, room_name=await self._get_room_name(evt.room_id),
+            displayname, room_name = await asyncio.gather(
+                self._get_displayname(evt.room_id, evt.sender) if evt.content.is_direct
+                else _noop(), self._get_room_name(evt.room_id))
+            control_room = self.router.route(evt.sender, room_name)
+            case = self.case(id=evt.room_id, room_name=room_name,
                              user_id=evt.sender if evt.content.is_direct else None,
-                             displayname=displayname, last_bot_msg=now_ms())
-            if self.template_enabled("welcome"):
-                await self.client.send_markdown(evt.room_id,
-                                                self.render("welcome", evt=evt, case=case))
-            case.insert()
+                             displayname=displayname, last_bot_msg=now_ms(),
+                             state=CaseState.OPEN.value,
+                             control_room=control_room if control_room != self.control_room
+                             else None)
+            await case.insert()
+            self.router.opened(control_room)
             self.cases[evt.room_id] = case
+            self.non_cases.pop(evt.room_id, None)
         except Exception:
             self.log.exception(f"Failed to handle invite from {evt.sender}")
             if self.template_enabled("invite_error"):
-                await self.client.send_markdown(self.control_room,
-                                                self.render("invite_error", evt=evt))
+                self.outbox.submit(partial(self.client.send_markdown, self.control_room,
+                                           self.render("invite_error", evt=evt)),
+                                   lane=self.control_room,
+                                   description=f"send invite error for {evt.room_id}")
             return
-        event_id = await self.client.send_markdown(self.control_room,
-                                                   self.render("new_case", evt=evt, case=case))
-        self.control_event(event_id=event_id, timestamp=now_ms(), case=evt.room_id,
-                           index=0).insert()
+        # Other instances may have cached the room as not being a case
+        await self.coordinator.publish(f"case:{evt.room_id}")
+        if self.template_enabled("welcome"):
+            self.outbox.submit(partial(self.client.send_markdown, evt.room_id,
+                                       self.render("welcome", evt=evt, case=case)),
+                               lane=evt.room_id, priority=Priority.CUSTOMER,
+                               description=f"send welcome message to {evt.room_id}")
+        self.send_control_event(case, self.render("new_case", evt=evt, case=case))
+        self.schedule_reminder(case, self.reminder_after)
 
-    @event.on(InternalEventType.JOIN)
-    async def control_join_handler(self, evt: StateEvent) -> None:
-        if evt.room_id == self.control_room and evt.state_key != self.client.mxid:
-            self.agents.add(UserID(evt.state_key))
-
-    @event.on(InternalEventType.LEAVE)
-    async def control_leave_handler(self, evt: StateEvent) -> None:
-        if evt.room_id == self.control_room:
-            self.agents.remove(UserID(evt.state_key))
+    @event.on(EventType.ROOM_MEMBER)
+    @timed_handler
+    async def control_member_handler(self, evt: StateEvent) -> None:
+        if (evt.room_id not in self.control_rooms or evt.state_key == self.client.mxid
+                or not await self.coordinator.owns(evt.room_id)):
+            return
+        elif evt.content.membership == Membership.JOIN:
+            await self.agents.add(evt.room_id, UserID(evt.state_key))
+        else:
+            await self.agents.remove(evt.room_id, UserID(evt.state_key))
+        await self.coordinator.publish(f"agents:{evt.room_id}")
 
     @event.on(InternalEventType.JOIN)
     @ignore_control_bot
     @with_case
+    @timed_handler
     async def join_handler(self, evt: StateEvent, case: Case) -> None:
-        if evt.state_key in self.agents:
-            members = await self.get_room_members(evt.room_id)
-            members[evt.sender] = evt.content
-
-            await self.update_case_status(case, members)
+        members = self.room_members.get(evt.room_id)
+        if members is not None:
+            members[UserID(evt.state_key)] = evt.content
+        if evt.state_key in self.case_agents(case):
+            if members is None:
+                await self.get_room_members(evt.room_id)
+            self.update_case_status(case)
         elif case.last_bot_msg + self.new_user_cooldown < evt.timestamp:
             if self.template_enabled("new_user"):
-                await self.client.send_markdown(evt.room_id,
-                                                self.render("new_user", evt=evt, case=case))
-            case.edit(last_bot_msg=now_ms())
+                self.outbox.submit(partial(self.client.send_markdown, evt.room_id,
+                                           self.render("new_user", evt=evt, case=case)),
+                                   lane=evt.room_id, priority=Priority.CUSTOMER,
+                                   description=f"send new user message to {evt.room_id}")
+            await self.case_writer.edit(case, last_bot_msg=now_ms())
 
     @event.on(InternalEventType.LEAVE)
     @ignore_control_bot
     @with_case
+    @timed_handler
     async def leave_handler(self, evt: StateEvent, case: Case) -> None:
-        ctrl = self.control_event.latest_for_case(case.id)
-        if evt.state_key in self.agents:
+        await self.handle_member_removed(evt, case)
+
+    @event.on(InternalEventType.KICK)
+    @ignore_control_bot
+    @with_case
+    @timed_handler
+    async def kick_handler(self, evt: StateEvent, case: Case) -> None:
+        await self.handle_member_removed(evt, case)
+
+    @event.on(InternalEventType.BAN)
+    @ignore_control_bot
+    @with_case
+    @timed_handler
+    async def ban_handler(self, evt: StateEvent, case: Case) -> None:
+        await self.handle_member_removed(evt, case)
+
+    async def handle_member_removed(self, evt: StateEvent, case: Case) -> None:
+        members = self.room_members.get(evt.room_id)
+        if members is not None:
+            members.pop(UserID(evt.state_key), None)
+        ctrl = await self.get_latest_control_event(case.id)
+        if evt.state_key in self.case_agents(case):
             if ctrl:
-                accept = self.case_accept.get_by_ctrl(ctrl.event_id, evt.sender)
+                accept = await self.case_accept.get_by_ctrl(ctrl.event_id, evt.state_key)
                 if accept:
-                    await self.client.redact(self.control_room, accept.event_id,
-                                             "Agent left room")
-                    accept.delete()
+                    self.outbox.submit(partial(self.client.redact, self.case_control_room(case),
+                                               accept.event_id, "Agent left room"),
+                                       lane=self.control_lane(case),
+                                       description=f"redact claim {accept.event_id}")
+                    await accept.delete()
+            if (case.state == CaseState.OPEN and members is not None
+                    and len(members.keys() & self.case_agents(case)) == 0
+                    and case.id not in self.reminders):
+                self.schedule_reminder(case, self.reminder_after)
 
-            members = await self.get_room_members(evt.room_id)
-            try:
-                del members[evt.sender]
-            except KeyError:
-                pass
-
-            await self.update_case_status(case, members, ctrl)
-        elif (case.last_bot_msg + self.new_user_cooldown < evt.timestamp
-              and evt.state_key == case.user_id and ctrl):
-            if self.template_enabled("case_closed"):
-                await self.client.send_markdown(
-                    room_id=self.control_room, edits=ctrl.event_id,
-                    markdown=self.render("case_closed", case=case, evt=evt))
-            case.edit(last_bot_msg=now_ms())
-
-    async def update_case_status(self, case: Case, members: Dict[str, Member],
-                                 ctrl: Optional[ControlEvent] = None) -> None:
-        ctrl = ctrl or self.control_event.latest_for_case(case.id)
-        if not ctrl:
-            self.log.warning(f"Tried to update case {case} with no control event")
+            self.update_case_status(case)
+        elif evt.state_key == case.user_id:
+            await self.close_case(case, "case_closed", evt)
+
+    async def close_case(self, case: Case, template: str, evt: Union[StateEvent, MessageEvent]
+                         ) -> bool:
+        if case.state == CaseState.CLOSED:
+            return False
+        self.cancel_status_update(case)
+        self.reminders.cancel(case.id)
+        await self.case_writer.edit(case, state=CaseState.CLOSED.value, closed_at=now_ms())
+        self.router.closed(case.control_room)
+        ctrl = await self.get_latest_control_event(case.id)
+        if ctrl and self.template_enabled(template):
+            self.edit_control_event(case, ctrl, self.render(template, case=case, evt=evt))
+        await self.release_closed_case(case)
+        return True
+
+    async def release_closed_case(self, case: Case) -> None:
+        # Closed cases only need a lease again when the customer comes back, so they don't
+        # have to be renewed until then. Events of the room that are already queued keep it.
+        if (case.state != CaseState.CLOSED or case.id not in self.coordinator.owned
+                or self.room_queues.queues.get(case.id)):
             return
-        agents = {key: value for key, value in members.items() if key in self.agents}
-        if self.template_enabled("case_status"):
-            await self.client.send_markdown(room_id=self.control_room, edits=ctrl.event_id,
-                                            markdown=self.render("case_status", case=case,
-                                                                 agents=agents))
+        await self.on_room_lost(case.id)
+        await self.coordinator.release(case.id)
+
+    def update_case_status(self, case: Case) -> None:
+        # Updates are coalesced: the status is rendered once the delay passes, so everything
+        # that happened in the meantime ends up in a single edit.
+        if case.id in self.status_updates or not self.template_enabled("case_status"):
+            return
+        self.status_updates[case.id] = self.loop.call_later(self.status_update_delay,
+                                                            self._flush_case_status, case)
+
+    def cancel_status_update(self, case: Case) -> None:
+        try:
+            self.status_updates.pop(case.id).cancel()
+        except KeyError:
+            pass
+
+    def _flush_case_status(self, case: Case) -> None:
+        self.status_updates.pop(case.id, None)
+        # The status is rendered in the room's queue, so it can't be sent between a claim and
+        # its accepted edit
+        asyncio.ensure_future(self.room_queues.submit(case.id,
+                                                      partial(self._send_case_status, case)),
+                              loop=self.loop)
+
+    async def _send_case_status(self, case: Case) -> None:
+        try:
+            ctrl = await self.get_latest_control_event(case.id)
+            if not ctrl:
+                self.log.warning(f"Tried to update case {case} with no control event")
+                return
+            members = await self.get_room_members(case.id)
+            agents = {key: value for key, value in members.items()
+                      if key in self.case_agents(case)}
+            self.edit_control_event(case, ctrl,
+                                    self.render("case_status", case=case, agents=agents),
+                                    priority=Priority.STATUS)
+        except Exception:
+            self.log.exception(f"Failed to update status of case {case.id}")
+
+    def control_lane(self, case: Case) -> Hashable:
+        # Control room requests are only ordered relative to other requests about the same case
+        return self.case_control_room(case), case.id
+
+    def edit_control_event(self, case: Case, ctrl: ControlEvent, markdown: str,
+                           priority: Priority = Priority.CONTROL) -> None:
+        if self.last_control_edit.get(case.id) == (ctrl.index, markdown):
+            return
+        self.last_control_edit[case.id] = (ctrl.index, markdown)
+
+        def forget_failed_edit(future: asyncio.Future) -> None:
+            if future.cancelled() or future.exception():
+                self.last_control_edit.pop(case.id, None)
+
+        # Edits of the same control event replace each other while queued
+        self.outbox.submit(partial(self._edit_control_event, self.case_control_room(case), ctrl,
+                                   markdown),
+                           lane=self.control_lane(case), priority=priority,
+                           key=("edit", case.id, ctrl.index),
+                           description=f"edit control event of {case.id}"
+                           ).add_done_callback(forget_failed_edit)
 
     @event.on(EventType.ROOM_NAME)
     @with_case
+    @timed_handler
     async def room_name_handler(self, evt: StateEvent, case: Case) -> None:
         if evt.content.name != case.room_name:
-            case.edit(room_name=evt.content.name)
-            await self.update_case_status(case, await self.get_room_members(evt.room_id))
+            await self.case_writer.edit(case, room_name=evt.content.name)
+            self.update_case_status(case)
 
     @event.on(InternalEventType.PROFILE_CHANGE)
     @ignore_control_bot
     @with_case
+    @timed_handler
     async def displayname_change_handler(self, evt: StateEvent, case: Case) -> None:
+        members = self.room_members.get(evt.room_id)
+        if members is not None:
+            members[UserID(evt.state_key)] = evt.content
         if case.user_id == evt.state_key and evt.content.displayname != case.displayname:
-            case.edit(displayname=evt.content.displayname)
-            await self.update_case_status(case, await self.get_room_members(evt.room_id))
+            await self.case_writer.edit(case, displayname=evt.content.displayname)
+            self.update_case_status(case)
+        elif evt.state_key in self.case_agents(case):
+            self.update_case_status(case)
 
     @event.on(EventType.ROOM_MESSAGE)
-    @with_case
-    async def case_message_handler(self, evt: MessageEvent, case: Case) -> None:
-        if evt.room_id == self.control_room or (evt.sender in self.agents
-                                                or evt.sender == self.client.mxid):
+    async def case_message_handler(self, evt: MessageEvent) -> None:
+        if (evt.room_id in self.control_rooms or not await self.get_case(evt.room_id)
+                or not await self.coordinator.owns(evt.room_id)):
+            return
+        # Messages are added to the transcript here rather than in the queued handler, as queued
+        # messages replace each other
+        elif self.transcripts.enabled:
+            self.transcripts.append(evt.room_id, evt.serialize())
+        if evt.sender in self.agents or evt.sender == self.client.mxid:
+            return
+        await self.handle_case_message(evt)
+
+    # Only the newest of several queued messages is handled, as they'd all make the same checks
+    @with_case(collapse=True)
+    @timed_handler
+    async def handle_case_message(self, evt: MessageEvent, case: Case) -> None:
+        reopened = case.state == CaseState.CLOSED
+        if reopened:
+            await self.case_writer.edit(case, state=CaseState.OPEN.value, closed_at=None)
+            self.router.opened(case.control_room)
+        members = await self.get_room_members(case.id)
+        if len(members.keys() & self.case_agents(case)) == 0:
+            prev_ctrl = await self.get_latest_control_event(case.id)
+            if prev_ctrl and (reopened
+                              or prev_ctrl.timestamp + self.new_message_cooldown < now_ms()):
+                if case.state != CaseState.OPEN:
+                    await self.case_writer.edit(case, state=CaseState.OPEN.value)
+                self.replace_control_event(case, prev_ctrl,
+                                           self.render("case_message", evt=evt, case=case))
+                self.schedule_reminder(case, self.reminder_after)
+                return
+        if reopened:
+            # The closed notice is only replaced with the status if no new notice was posted
+            self.update_case_status(case)
+
+    def replace_control_event(self, case: Case, prev_ctrl: ControlEvent, markdown: str) -> None:
+        self.outbox.submit(partial(self._redact_control_event, self.case_control_room(case),
+                                   prev_ctrl, "Control event replaced"),
+                           lane=self.control_lane(case),
+                           description=f"redact old control event of {case.id}")
+        self.send_control_event(case, markdown, index=prev_ctrl.index + 1)
+
+    def schedule_reminder(self, case: Case, delay: int) -> None:
+        if delay > 0 and self.template_enabled("case_reminder"):
+            self.reminders.schedule(case.id, now_ms() + delay)
+
+    async def load_reminders(self) -> None:
+        if self.reminder_after <= 0 or not self.template_enabled("case_reminder"):
+            return
+        for room_id, timestamp in (await self.case.latest_notice_of_open()).items():
+            self.reminders.schedule(room_id, timestamp + self.reminder_after)
+
+    async def send_reminders(self, room_ids: List[RoomID]) -> None:
+        # Reminders go through the room queues, so they can't race with events of the case
+        for room_id in room_ids:
+            if await self.coordinator.owns(room_id):
+                await self.room_queues.submit(room_id, partial(self.remind_case, room_id))
+            else:
+                # Checking again later lets this instance take over if the owner goes away
+                self.reminders.schedule(room_id, now_ms() + self.reminder_after)
+
+    async def remind_case(self, room_id: RoomID) -> None:
+        case = await self.get_case(room_id)
+        if (not case or case.state != CaseState.OPEN
+                or not self.template_enabled("case_reminder")):
             return
         members = await self.get_room_members(case.id)
-        if len(members.keys() & self.agents) == 0:
-            prev_ctrl = self.control_event.latest_for_case(case.id)
-            if prev_ctrl and prev_ctrl.timestamp + self.new_message_cooldown < now_ms():
-                await self.client.redact(self.control_room, prev_ctrl.event_id,
-                                         "Control event replaced")
-                event_id = await self.client.send_markdown(
-                    self.control_room, self.render("case_message", evt=evt, case=case))
-                self.control_event(event_id=event_id, timestamp=now_ms(), case=evt.room_id,
-                                   index=(prev_ctrl.index + 1) if prev_ctrl else 0).insert()
+        if len(members.keys() & self.case_agents(case)) > 0:
+            return
+        prev_ctrl = await self.get_latest_control_event(case.id)
+        if not prev_ctrl:
+            return
+        self.replace_control_event(case, prev_ctrl, self.render("case_reminder", case=case))
+        self.metrics.reminders_sent.inc()
+        self.schedule_reminder(case, self.reminder_repeat)
 
     @command.passive(CLAIM_EMOJI)
     async def claim_case_reply(self, evt: MessageEvent, _: Tuple[str]) -> None:
@@ -290,30 +831,212 @@ class SupportPortalBot(Plugin):
         await self._claim_case(evt)
 
     async def _claim_case(self, evt: Union[ReactionEvent, MessageEvent]) -> None:
-        if evt.room_id != self.control_room:
+        if evt.room_id not in self.control_rooms:
             return
-        ctrl = self.control_event.get(evt.content.relates_to.event_id)
-        if ctrl is None:
+        ctrl = await self.get_control_event(evt.content.relates_to.event_id)
+        if ctrl is None or not await self.coordinator.owns(ctrl.case):
             return
-        case = self.get_case(ctrl.case)
-        self.case_accept(event_id=evt.event_id, control_event=ctrl.event_id, case=case.id,
-                         user_id=evt.sender).insert()
-        await self.client.invite_user(case.id, evt.sender)
+        case = await self.get_case(ctrl.case)
+        # Control events can only be claimed in the control room they were sent to
+        if not case or self.case_control_room(case) != evt.room_id:
+            return
+        # Claims are handled in order with the other events of the case room, so claiming the
+        # same case several times only results in one invite and one accepted edit.
+        await self.room_queues.submit(case.id, partial(self._handle_claim, evt, case, ctrl))
 
-        members = await self.get_room_members(case.id)
-        # If we already have agents in the room, we don't want to edit to show
-        # the case accepted message.
-        if len(members.keys() & self.agents) == 0:
-            member = await self.client.get_state_event(evt.room_id, EventType.ROOM_MEMBER,
-                                                       evt.sender)
-            if self.template_enabled("case_accepted"):
-                await self.client.send_markdown(
-                    room_id=self.control_room, edits=ctrl.event_id,
-                    markdown=self.render("case_accepted", case=case, evt=evt,
-                                         sender_displayname=member.displayname))
+    @timed_handler
+    async def _handle_claim(self, evt: Union[ReactionEvent, MessageEvent], case: Case,
+                            ctrl: ControlEvent) -> None:
+        accepts, members = await asyncio.gather(self.case_accept.all_by_ctrl(ctrl.event_id),
+                                                self.get_room_members(case.id))
+        if any(accept.user_id == evt.sender for accept in accepts):
+            self.log.debug(f"Ignoring duplicate claim of {case.id} by {evt.sender}")
+            return
+        # If we already have agents in the room (or someone already claimed this control
+        # event), we don't want to edit to show the case accepted message.
+        show_accepted = (not accepts and len(members.keys() & self.case_agents(case)) == 0
+                         and self.template_enabled("case_accepted"))
+        if evt.sender not in members:
+            self.outbox.submit(partial(self.client.invite_user, case.id, evt.sender),
+                               lane=case.id, priority=Priority.CUSTOMER,
+                               description=f"invite {evt.sender} to {case.id}")
+        accept_result, displayname = await asyncio.gather(
+            self.case_accept(event_id=evt.event_id, control_event=ctrl.event_id, case=case.id,
+                             user_id=evt.sender).insert(),
+            self._get_displayname(evt.room_id, evt.sender) if show_accepted else _noop(),
+            return_exceptions=True)
+        if isinstance(accept_result, Exception):
+            self.log.warning(f"Failed to store claim of {case.id} by {evt.sender}: "
+                             f"{accept_result}")
+        if not accepts:
+            self.metrics.time_to_claim.observe((now_ms() - ctrl.timestamp) / 1000)
+        if case.state == CaseState.OPEN:
+            await self.case_writer.edit(case, state=CaseState.CLAIMED.value)
+        self.reminders.cancel(case.id)
+        if show_accepted:
+            if isinstance(displayname, Exception):
+                displayname = None
+            self.cancel_status_update(case)
+            self.edit_control_event(case, ctrl, self.render(
+                "case_accepted", case=case, evt=evt, sender_displayname=displayname))
 
     @event.on(EventType.ROOM_REDACTION)
+    @timed_handler
     async def redaction_handler(self, evt: RedactionEvent) -> None:
-        if evt.room_id != self.control_room or evt.sender == self.client.mxid:
+        if (evt.room_id not in self.control_rooms or evt.sender == self.client.mxid
+                or not await self.coordinator.owns(evt.room_id)):
             return
-        self.case_accept.delete_by_id(evt.redacts)
+        await self.case_accept.delete_by_id(evt.redacts)
+
+    @command.new("support", help="Support portal management")
+    async def support_command(self, evt: MessageEvent) -> None:
+        pass
+
+    @support_command.subcommand("close", help="Close a case. In the control room, the case "
+                                              "room ID must be given.")
+    @command.argument("room_id", required=False)
+    async def close_command(self, evt: MessageEvent, room_id: Optional[str]) -> None:
+        if evt.sender not in self.agents:
+            return
+        elif evt.room_id in self.control_rooms:
+            if not room_id:
+                await evt.reply("Usage: `!support close <case room ID>`")
+                return
+        else:
+            room_id = evt.room_id
+        if not await self.get_case(RoomID(room_id)):
+            # Rooms that aren't cases aren't leased, so the instance handling the control room
+            # replies, or the only instance if there's one
+            if (await self.coordinator.owns(evt.room_id) if evt.room_id in self.control_rooms
+                    else not self.coordinator.enabled):
+                await evt.reply("That room is not a case")
+            return
+        elif not await self.coordinator.owns(room_id):
+            return
+        # Acquiring the lease may have dropped the cached case
+        case = await self.get_case(RoomID(room_id))
+        closed = await (await self.room_queues.submit(
+            case.id, partial(self.close_case, case, "case_closed_by_agent", evt)))
+        if closed:
+            await evt.react("\u2705")
+        else:
+            await evt.reply("That case is already closed")
+
+    @support_command.subcommand("backfill", help="Save earlier messages of a case to its "
+                                                 "transcript. Without a room ID, all cases are "
+                                                 "backfilled.")
+    @command.argument("room_id", required=False)
+    async def backfill_command(self, evt: MessageEvent, room_id: Optional[str]) -> None:
+        if (evt.room_id not in self.control_rooms or evt.sender not in self.agents
+                or not await self.coordinator.owns(evt.room_id)):
+            return
+        elif not self.transcripts.enabled:
+            await evt.reply("Transcripts are disabled")
+            return
+        if room_id:
+            if not await self.get_case(RoomID(room_id)):
+                await evt.reply("That room is not a case")
+                return
+            room_ids = [RoomID(room_id)]
+        else:
+            room_ids = await self.case.all_ids()
+        await evt.reply(f"Backfilling transcripts of {len(room_ids)} cases")
+        # Cases are backfilled one by one, so only one page of messages is in memory at a time
+        page_size = self.config["transcripts.backfill_page_size"]
+        saved = skipped = failed = 0
+        for case_id in room_ids:
+            try:
+                count = await self.transcripts.backfill(self.client, case_id, page_size)
+            except Exception as e:
+                self.log.warning(f"Failed to backfill transcript of {case_id}: {e}")
+                failed += 1
+                continue
+            if count is None:
+                skipped += 1
+            else:
+                saved += count
+        await evt.reply(f"Saved {saved} messages. {skipped} cases were already backfilled, "
+                        f"{failed} failed.")
+
+    @support_command.subcommand("caches", help="Show in-memory cache statistics")
+    async def cache_stats_command(self, evt: MessageEvent) -> None:
+        if evt.room_id not in self.control_rooms:
+            return
+        lines = [f"* **{cache.name}**: {cache.stats['size']}/{cache.max_size} entries, "
+                 f"{cache.hits} hits, {cache.misses} misses, {cache.evictions} evictions"
+                 for cache in self.caches]
+        lines.append(f"* **room queues**: {len(self.room_queues)} queued events in "
+                     f"{len(self.room_queues.queues)} rooms, "
+                     f"{self.room_queues.collapsed} collapsed")
+        lines.append(f"* **reminders**: {len(self.reminders)} scheduled")
+        lines.append(f"* **transcripts**: {len(self.transcripts)} buffered messages")
+        lines.append(f"* **write-behind**: {len(self.case_writer)} cases with unsaved changes")
+        lines.append(f"* **outbox**: {len(self.outbox)} queued requests, "
+                     f"{self.outbox.superseded} superseded")
+        if self.coordinator.enabled:
+            lines.append(f"* **coordination**: instance `{self.coordinator.instance}` holds "
+                         f"{len(self.coordinator.owned)} leases")
+        await evt.reply("\n".join(lines))
+
+    @support_command.subcommand("templates", help="Show template render statistics")
+    async def template_stats_command(self, evt: MessageEvent) -> None:
+        if evt.room_id not in self.control_rooms:
+            return
+        lines = [f"* **{name}**: {count} renders, "
+                 f"{self.templates.render_time[name] / count * 1000:.3f} ms on average"
+                 for name, count in sorted(self.templates.render_count.items())]
+        await evt.reply("\n".join(lines) or "No templates rendered yet")
+
+    async def _collect_metrics(self) -> None:
+        for state, count in (await self.case.count_by_state()).items():
+            self.metrics.cases.set(count, state=state)
+        unattended = 0
+        for case in self.cases.values():
+            members = self.room_members.peek(case.id)
+            if members is not None and len(members.keys() & self.case_agents(case)) == 0:
+                unattended += 1
+        self.metrics.unattended_cases.set(unattended)
+        self.metrics.outbox_queued.set(len(self.outbox))
+        self.metrics.unsaved_cases.set(len(self.case_writer))
+        self.metrics.outbox_superseded.set(self.outbox.superseded)
+        self.metrics.queued_events.set(len(self.room_queues))
+        self.metrics.scheduled_reminders.set(len(self.reminders))
+        self.metrics.queued_rooms.set(len(self.room_queues.queues))
+        self.metrics.collapsed_events.set(self.room_queues.collapsed)
+        self.metrics.owned_leases.set(len(self.coordinator.owned))
+        for cache in self.caches:
+            self.metrics.cache_size.set(len(cache), cache=cache.name)
+            self.metrics.cache_hits.set(cache.hits, cache=cache.name)
+            self.metrics.cache_misses.set(cache.misses, cache=cache.name)
+            self.metrics.cache_evictions.set(cache.evictions, cache=cache.name)
+        for name, count in self.templates.render_count.items():
+            self.metrics.template_renders.set(count, template=name)
+            self.metrics.template_render_time.set(self.templates.render_time[name],
+                                                  template=name)
+
+    @web.get("/transcript/{room_id}")
+    async def transcript_handler(self, request: Request) -> StreamResponse:
+        token = self.config["transcripts.export_token"]
+        if not token or not self.transcripts.enabled:
+            return Response(status=404)
+        elif not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            return Response(status=401)
+        room_id = RoomID(request.match_info["room_id"])
+        await self.transcripts.flush(room_id)
+        if not await self.loop.run_in_executor(None, self.transcripts.paths, room_id):
+            return Response(status=404)
+        # The segments are concatenated gzip streams, so they're sent as-is without decompressing
+        response = StreamResponse(headers={
+            "Content-Type": "application/gzip",
+            "Content-Disposition": f'attachment; filename="{quote(room_id, safe="")}.jsonl.gz"',
+        })
+        await response.prepare(request)
+        async for chunk in self.transcripts.read(room_id):
+            await response.write(chunk)
+        await response.write_eof()
+        return response
+
+    @web.get("/metrics")
+    async def metrics_handler(self, _: Request) -> Response:
+        return Response(text=await self.metrics.render(),
+                        headers={"Content-Type": "text/plain; version=0.0.4; charset=utf-8"})
@@ -0,0 +1,131 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Generic, TypeVar, Dict, Tuple, Iterator, Optional, Any
+from collections import OrderedDict
+from time import monotonic
+
+K = TypeVar("K")
+V = TypeVar("V")
+
+_missing = object()
+
+
+# A size-limited mapping that evicts the least recently used entries first. Entries can also
+# expire ttl seconds after being stored. Only get() and [] lookups count towards hits/misses.
+class LRUCache(Generic[K, V]):
+    name: str
+    max_size: int
+    ttl: float
+    hits: int
+    misses: int
+    evictions: int
+    _data: 'OrderedDict[K, Tuple[V, float]]'
+
+    def __init__(self, name: str, max_size: int, ttl: float = 0) -> None:
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._data = OrderedDict()
+
+    def configure(self, max_size: int, ttl: float = 0) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self._shrink()
+
+    def _shrink(self) -> None:
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def _lookup(self, key: K) -> Any:
+        try:
+            value, stored_at = self._data[key]
+        except KeyError:
+            return _missing
+        if self.ttl and stored_at + self.ttl < monotonic():
+            del self._data[key]
+            self.evictions += 1
+            return _missing
+        self._data.move_to_end(key)
+        return value
+
+    def __getitem__(self, key: K) -> V:
+        value = self._lookup(key)
+        if value is _missing:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        return value
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def peek(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        # Like get(), but doesn't update the LRU order or the hit/miss counters
+        try:
+            return self._data[key][0]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key: K, value: V) -> None:
+        self._data[key] = (value, monotonic())
+        self._data.move_to_end(key)
+        self._shrink()
+
+    def __delitem__(self, key: K) -> None:
+        del self._data[key]
+
+    def __contains__(self, key: K) -> bool:
+        return self._lookup(key) is not _missing
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __iter__(self) -> Iterator[K]:
+        return iter(list(self._data.keys()))
+
+    def values(self) -> Iterator[V]:
+        return (value for value, _ in list(self._data.values()))
+
+    def items(self) -> Iterator[Tuple[K, V]]:
+        return ((key, value) for key, (value, _) in list(self._data.items()))
+
+    def pop(self, key: K, default: Any = _missing) -> V:
+        try:
+            return self._data.pop(key)[0]
+        except KeyError:
+            if default is _missing:
+                raise
+            return default
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._data),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
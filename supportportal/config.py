@@ -13,9 +13,11 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Tuple, Iterable, Any, Callable
+from typing import Tuple, Iterable, Dict, Any, Callable
+from logging import Logger
+from time import perf_counter
 
-from jinja2 import BaseLoader, TemplateNotFound
+from jinja2 import BaseLoader, TemplateNotFound, TemplateError, Template, Environment
 
 from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 
@@ -23,10 +25,49 @@ from mautrix.util.config import BaseProxyConfig, ConfigUpdateHelper
 class Config(BaseProxyConfig):
     def do_update(self, helper: ConfigUpdateHelper) -> None:
         helper.copy("control_room")
+        helper.copy("routing.rules")
+        helper.copy("routing.shards")
+        helper.copy("routing.strategy")
         helper.copy("new_user_cooldown")
         helper.copy("new_message_cooldown")
+        helper.copy("reminders.after")
+        helper.copy("reminders.repeat")
+        helper.copy("reminders.batch_size")
+        helper.copy("database_threads")
+        helper.copy("status_update_delay")
+        helper.copy("agent_resync_interval")
+        helper.copy("cache.cases")
+        helper.copy("cache.non_case_rooms")
+        helper.copy("cache.room_members")
+        helper.copy("cache.room_members_ttl")
+        helper.copy("warmup.enabled")
+        helper.copy("warmup.concurrency")
+        helper.copy("room_queues.concurrency")
+        helper.copy("room_queues.max_depth")
+        helper.copy("outbox.concurrency")
+        helper.copy("outbox.max_retries")
+        helper.copy("write_behind.interval")
+        helper.copy("write_behind.max_pending")
+        helper.copy("write_behind.write_through")
+        helper.copy("lifecycle.interval")
+        helper.copy("lifecycle.prune_control_events_after")
+        helper.copy("lifecycle.archive_after")
+        helper.copy("lifecycle.batch_size")
+        helper.copy("transcripts.directory")
+        helper.copy("transcripts.max_file_size")
+        helper.copy("transcripts.flush_interval")
+        helper.copy("transcripts.max_buffered")
+        helper.copy("transcripts.backfill_page_size")
+        helper.copy("transcripts.export_token")
+        helper.copy("coordination.enabled")
+        helper.copy("coordination.lease_ttl")
+        helper.copy("coordination.heartbeat_interval")
+        helper.copy("coordination.poll_interval")
+        helper.copy("precompile_templates")
         helper.copy("template_prepend")
-        helper.copy_dict("templates")
+        # Templates added since the config was created are kept, so new features like reminders
+        # work once they're enabled
+        helper.copy_dict("templates", override_existing_map=False)
 
 
 class ConfigTemplateLoader(BaseLoader):
@@ -51,3 +92,73 @@ class ConfigTemplateLoader(BaseLoader):
 
     def list_templates(self) -> Iterable[str]:
         return sorted(self.config["templates"].keys())
+
+
+class TemplateManager:
+    config: Config
+    log: Logger
+    loader: ConfigTemplateLoader
+    env: Environment
+
+    version: int
+    templates: Dict[str, Template]
+    enabled: Dict[str, bool]
+    render_count: Dict[str, int]
+    render_time: Dict[str, float]
+
+    def __init__(self, config: Config, log: Logger) -> None:
+        self.config = config
+        self.log = log
+        self.loader = ConfigTemplateLoader(config)
+        # Compiled templates are cached here per config version, so Jinja's own cache isn't needed
+        self.env = Environment(loader=self.loader, cache_size=0)
+        self.version = 0
+        self.templates = {}
+        self.enabled = {}
+        self.render_count = {}
+        self.render_time = {}
+
+    def reload(self) -> None:
+        self.loader.reload()
+        self.version += 1
+        previous = self.templates
+        self.templates = {}
+        self.enabled = {}
+        if self.config["precompile_templates"]:
+            self.precompile(previous)
+
+    def precompile(self, previous: Dict[str, Template]) -> None:
+        for name in self.loader.list_templates():
+            try:
+                self.templates[name] = self.env.get_template(name)
+            except TemplateError as e:
+                if name in previous:
+                    self.log.error(f"Failed to compile template {name}: {e}. "
+                                   "Keeping previous version.")
+                    self.templates[name] = previous[name]
+                else:
+                    self.log.error(f"Failed to compile template {name}: {e}")
+
+    def is_enabled(self, name: str) -> bool:
+        try:
+            return self.enabled[name]
+        except KeyError:
+            # Configs from before a template was added don't have it, which disables it
+            ok = self.enabled[name] = bool(self.config["templates"].get(name))
+            return ok
+
+    def get(self, name: str) -> Template:
+        try:
+            return self.templates[name]
+        except KeyError:
+            template = self.templates[name] = self.env.get_template(name)
+            return template
+
+    def render(self, name: str, **kwargs) -> str:
+        template = self.get(name)
+        start = perf_counter()
+        try:
+            return template.render(**kwargs)
+        finally:
+            self.render_count[name] = self.render_count.get(name, 0) + 1
+            self.render_time[name] = self.render_time.get(name, 0) + perf_counter() - start
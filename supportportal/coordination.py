@@ -0,0 +1,213 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple, Type
+from logging import Logger
+from time import time
+import asyncio
+
+from .db import Lease, Invalidation
+
+KeyHandler = Callable[[str], Awaitable[None]]
+
+RELEASED_PREFIX = "released:"
+# Invalidations are only needed until every instance has polled them
+INVALIDATION_RETENTION = 60 * 60 * 1000
+
+
+def _now() -> int:
+    return int(time() * 1000)
+
+
+# Lets several instances of the plugin share a database. Each room is leased to one instance,
+# which handles its events while the other instances skip them. Leases are renewed by a
+# heartbeat, and an instance that stops renewing them loses its rooms to whichever instance
+# sees an event for them next. Changes that other instances have to reload are announced
+# through the invalidation table, which every instance polls.
+class Coordinator:
+    loop: asyncio.AbstractEventLoop
+    log: Logger
+    instance: str
+    lease: Optional[Type[Lease]]
+    invalidation: Optional[Type[Invalidation]]
+    on_acquired: Optional[KeyHandler]
+    on_lost: Optional[KeyHandler]
+    on_invalidated: Optional[KeyHandler]
+
+    enabled: bool
+    lease_ttl: int
+    heartbeat_interval: float
+    poll_interval: float
+
+    owned: Dict[str, int]
+    others: Dict[str, Tuple[str, int]]
+    last_id: int
+    tasks: List[asyncio.Future]
+    _acquiring: Dict[str, asyncio.Future]
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, log: Logger, instance: str) -> None:
+        self.loop = loop
+        self.log = log
+        self.instance = instance
+        self.lease = None
+        self.invalidation = None
+        self.on_acquired = None
+        self.on_lost = None
+        self.on_invalidated = None
+        self.enabled = False
+        self.lease_ttl = 30_000
+        self.heartbeat_interval = 10
+        self.poll_interval = 2
+        self.owned = {}
+        self.others = {}
+        self.last_id = 0
+        self.tasks = []
+        self._acquiring = {}
+
+    def configure(self, enabled: bool, lease_ttl: float, heartbeat_interval: float,
+                  poll_interval: float) -> None:
+        # Turning coordination on or off only takes effect when the plugin is restarted
+        if self.lease is None:
+            self.enabled = enabled
+        self.lease_ttl = int(lease_ttl * 1000)
+        self.heartbeat_interval = heartbeat_interval
+        self.poll_interval = poll_interval
+
+    async def start(self, lease: Type[Lease], invalidation: Type[Invalidation]) -> None:
+        self.lease = lease
+        self.invalidation = invalidation
+        if not self.enabled:
+            return
+        self.last_id = await self.invalidation.latest_id()
+        self.tasks = [asyncio.ensure_future(self._heartbeat_loop(), loop=self.loop),
+                      asyncio.ensure_future(self._poll_loop(), loop=self.loop)]
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        if self.enabled and self.owned:
+            # Let other instances take over without waiting for the leases to expire
+            try:
+                await self.lease.release(self.instance)
+                await self.publish(RELEASED_PREFIX + self.instance)
+            except Exception:
+                self.log.exception("Failed to release leases")
+            self.owned = {}
+
+    async def owns(self, key: str) -> bool:
+        if not self.enabled:
+            return True
+        now = _now()
+        # Leases are renewed well before they expire, so a lease that's about to expire wasn't
+        # renewed and may have been taken over
+        if self.owned.get(key, 0) > now + self.lease_ttl // 4:
+            return True
+        elif self.others.get(key, ("", 0))[1] > now:
+            return False
+        # Concurrent checks of the same key share one query, so their events stay in order
+        try:
+            future = self._acquiring[key]
+        except KeyError:
+            future = self._acquiring[key] = asyncio.ensure_future(self._acquire(key),
+                                                                 loop=self.loop)
+            future.add_done_callback(lambda _: self._acquiring.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def _acquire(self, key: str) -> bool:
+        now = _now()
+        try:
+            owner, expires_at = await self.lease.acquire(key, self.instance, now,
+                                                         now + self.lease_ttl)
+        except Exception:
+            self.log.exception(f"Failed to acquire lease of {key}")
+            return False
+        if owner != self.instance:
+            self.others[key] = (owner, expires_at)
+            if self.owned.pop(key, None) is not None:
+                self.log.debug(f"Lost lease of {key}")
+                if self.on_lost:
+                    await self.on_lost(key)
+            return False
+        # The lease may have been held by an instance that this one never heard of, so anything
+        # cached before this instance owned the key may be outdated
+        acquired = key not in self.owned
+        self.others.pop(key, None)
+        self.owned[key] = expires_at
+        if acquired and self.on_acquired:
+            self.log.debug(f"Acquired {key}")
+            await self.on_acquired(key)
+        return True
+
+    async def release(self, *keys: str) -> None:
+        # Gives up leases that this instance doesn't need anymore, so they aren't renewed
+        keys = [key for key in keys if self.owned.pop(key, None) is not None]
+        if not keys:
+            return
+        try:
+            await self.lease.release(self.instance, keys)
+        except Exception:
+            self.log.exception(f"Failed to release leases of {', '.join(keys)}")
+
+    async def publish(self, *keys: str) -> None:
+        if self.enabled and keys:
+            await self.invalidation.publish(keys, self.instance, _now())
+
+    async def _heartbeat_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.heartbeat()
+            except Exception:
+                self.log.exception("Failed to renew leases")
+
+    async def heartbeat(self) -> None:
+        now = _now()
+        expires_at = now + self.lease_ttl
+        renewing = set(self.owned)
+        held = set(await self.lease.renew(self.instance, expires_at))
+        # Leases acquired or released while renewing are left as they are
+        lost = [key for key in renewing if key not in held and key in self.owned]
+        for key in renewing & held:
+            if key in self.owned:
+                self.owned[key] = expires_at
+        self.others = {key: value for key, value in self.others.items() if value[1] > now}
+        for key in lost:
+            self.owned.pop(key, None)
+            self.log.debug(f"Lost lease of {key}")
+            if self.on_lost:
+                await self.on_lost(key)
+        await self.lease.prune(now - self.lease_ttl)
+        await self.invalidation.prune(now - INVALIDATION_RETENTION)
+
+    async def _poll_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            try:
+                await self.poll()
+            except Exception:
+                self.log.exception("Failed to check for changes by other instances")
+
+    async def poll(self) -> None:
+        for row_id, key in await self.invalidation.since(self.last_id, self.instance):
+            self.last_id = row_id
+            if key.startswith(RELEASED_PREFIX):
+                # The rooms of a stopped instance can be taken over without waiting for expiry
+                owner = key[len(RELEASED_PREFIX):]
+                for other_key, (other_owner, _) in list(self.others.items()):
+                    if other_owner == owner:
+                        self.others[other_key] = (owner, 0)
+            elif self.on_invalidated:
+                await self.on_invalidated(key)
@@ -13,16 +13,58 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Optional, Iterable
+from typing import Optional, List, Tuple, Dict, Iterable, Callable, Awaitable, TypeVar, Any
+from concurrent.futures import Executor
+from functools import partial, wraps
+from time import perf_counter, time
+from enum import Enum
+import asyncio
 
-from sqlalchemy import Column, String, Text, Integer, BigInteger, ForeignKey, UniqueConstraint
+from sqlalchemy import (Column, String, Text, Integer, BigInteger, ForeignKey, UniqueConstraint,
+                        Index, select, exists, and_, or_, bindparam, func as sql_func)
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.ext.declarative import declared_attr
 
 from mautrix.types import RoomID, EventID, UserID
 from mautrix.util.db import BaseClass
 
+from .metrics import Metrics
 
-class Case(BaseClass):
+T = TypeVar("T")
+
+
+def in_executor(func: Callable[..., T]) -> Callable[..., Awaitable[T]]:
+    @wraps(func)
+    async def wrapper(self_or_cls, *args, **kwargs) -> T:
+        start = perf_counter()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(
+                self_or_cls.executor, partial(func, self_or_cls, *args, **kwargs))
+        finally:
+            if self_or_cls.metrics:
+                cls = self_or_cls if isinstance(self_or_cls, type) else type(self_or_cls)
+                self_or_cls.metrics.db_latency.observe(perf_counter() - start,
+                                                       method=f"{cls.__name__}.{func.__name__}")
+
+    return wrapper
+
+
+class AsyncBaseClass(BaseClass):
+    executor: Optional[Executor] = None
+    metrics: Optional[Metrics] = None
+
+    insert = in_executor(BaseClass.insert)
+    edit = in_executor(BaseClass.edit)
+    delete = in_executor(BaseClass.delete)
+
+
+class CaseState(str, Enum):
+    OPEN = "open"
+    CLAIMED = "claimed"
+    CLOSED = "closed"
+
+
+class Case(AsyncBaseClass):
     __tablename__ = "case"
     id: RoomID = Column(String(255), primary_key=True)
     last_bot_msg: int = Column(BigInteger, nullable=False)
@@ -31,57 +73,335 @@ class Case(BaseClass):
     user_id: UserID = Column(String(255), nullable=True)
     displayname: str = Column(Text, nullable=True)
 
+    state: CaseState = Column(String(16), nullable=False, default=CaseState.OPEN.value,
+                              server_default=CaseState.OPEN.value)
+    closed_at: Optional[int] = Column(BigInteger, nullable=True)
+    # None means the default control room
+    control_room: Optional[RoomID] = Column(String(255), nullable=True)
+
+    @declared_attr
+    def __table_args__(self) -> Tuple[Index, ...]:
+        return Index("case_state_idx", "state", "closed_at"),
+
     @classmethod
+    @in_executor
     def get(cls, room_id: RoomID) -> Optional['Case']:
         return cls._select_one_or_none(cls.c.id == room_id)
 
+    @classmethod
+    @in_executor
+    def count_by_state(cls) -> Dict[str, int]:
+        return dict(cls.db.execute(select([cls.c.state, sql_func.count()])
+                                   .group_by(cls.c.state)).fetchall())
 
-class ControlEvent(BaseClass):
+    @classmethod
+    @in_executor
+    def count_active_by_control_room(cls) -> Dict[Optional[RoomID], int]:
+        return dict(cls.db.execute(select([cls.c.control_room, sql_func.count()])
+                                   .where(cls.c.state != CaseState.CLOSED.value)
+                                   .group_by(cls.c.control_room)).fetchall())
+
+    @classmethod
+    @in_executor
+    def all_recent(cls, limit: int) -> List['Case']:
+        return list(cls._all(cls.db.execute(
+            cls._make_simple_select(cls.c.state != CaseState.CLOSED.value)
+            .order_by(cls.c.last_bot_msg.desc())
+            .limit(limit))))
+
+    @classmethod
+    @in_executor
+    def all_ids(cls) -> List[RoomID]:
+        return [row[0] for row in cls.db.execute(select([cls.c.id]))]
+
+    @classmethod
+    @in_executor
+    def latest_notice_of_open(cls) -> Dict[RoomID, int]:
+        # The time of the latest control room notice of every case that hasn't been claimed
+        control_event = cls.metadata.tables["control_event"]
+        return dict(cls.db.execute(
+            select([cls.c.id, sql_func.max(control_event.c.timestamp)])
+            .select_from(cls.t.join(control_event, control_event.c.case == cls.c.id))
+            .where(cls.c.state == CaseState.OPEN.value)
+            .group_by(cls.c.id)).fetchall())
+
+    @classmethod
+    @in_executor
+    def archive_closed(cls, before: int, limit: int) -> List[RoomID]:
+        # Moves cases closed before the given time to the archive table and deletes their
+        # control events and claims
+        tables = cls.metadata.tables
+        archived_at = int(time() * 1000)
+        with cls.db.begin() as conn:
+            cases = list(cls._all(conn.execute(
+                cls._make_simple_select(cls.c.state == CaseState.CLOSED.value,
+                                        cls.c.closed_at < before)
+                .order_by(cls.c.closed_at)
+                .limit(limit))))
+            if not cases:
+                return []
+            room_ids = [case.id for case in cases]
+            conn.execute(tables["case_archive"].insert(), [{
+                "room_id": case.id, "room_name": case.room_name, "user_id": case.user_id,
+                "displayname": case.displayname, "last_bot_msg": case.last_bot_msg,
+                "closed_at": case.closed_at, "archived_at": archived_at,
+            } for case in cases])
+            case_accept = tables["case_accept"]
+            conn.execute(case_accept.delete().where(case_accept.c.case.in_(room_ids)))
+            control_event = tables["control_event"]
+            conn.execute(control_event.delete().where(control_event.c.case.in_(room_ids)))
+            conn.execute(cls.t.delete().where(cls.c.id.in_(room_ids)))
+        return room_ids
+
+    @classmethod
+    @in_executor
+    def edit_many(cls, changes: Dict[RoomID, Dict[str, Any]]) -> None:
+        # Rows that change the same columns are updated with a single executemany
+        groups: Dict[Tuple[str, ...], List[Dict[str, Any]]] = {}
+        for room_id, values in changes.items():
+            row = {f"_{key}": value for key, value in values.items()}
+            row["_id"] = room_id
+            groups.setdefault(tuple(sorted(values)), []).append(row)
+        with cls.db.begin() as conn:
+            for columns, rows in groups.items():
+                conn.execute(cls.t.update()
+                             .where(cls.c.id == bindparam("_id"))
+                             .values({column: bindparam(f"_{column}") for column in columns}),
+                             rows)
+
+
+class ControlEvent(AsyncBaseClass):
     __tablename__ = "control_event"
     event_id: EventID = Column(String(255), primary_key=True)
     timestamp: int = Column(BigInteger, nullable=False)
     case: RoomID
     index: int = Column(Integer, nullable=False)
 
+    @declared_attr
+    def __table_args__(self) -> Tuple[Index, ...]:
+        return Index("control_event_case_idx", "case", "index"),
+
     @declared_attr
     def case(self) -> RoomID:
         return Column(String(255), ForeignKey("case.id", ondelete="CASCADE", onupdate="CASCADE"),
                       nullable=False)
 
     @classmethod
+    @in_executor
     def get(cls, event_id: EventID) -> Optional['ControlEvent']:
         return cls._select_one_or_none(cls.c.event_id == event_id)
 
     @classmethod
+    @in_executor
     def latest_for_case(cls, room_id: RoomID) -> Optional['ControlEvent']:
         return cls._one_or_none(cls.db.execute(cls._make_simple_select(cls.c.case == room_id)
                                                .order_by(cls.c.index.desc(), cls.c.event_id.desc())
                                                .limit(1)))
 
     @classmethod
-    def all_for_case(cls, room_id: RoomID) -> Iterable['ControlEvent']:
-        yield from cls._all(cls.db.execute(cls._make_simple_select(cls.c.case == room_id)
-                                           .order_by(cls.c.index.desc(), cls.c.event_id.desc())))
+    @in_executor
+    def latest_for_cases(cls, room_ids: Iterable[RoomID], chunk_size: int = 500
+                         ) -> Dict[RoomID, 'ControlEvent']:
+        room_ids = list(room_ids)
+        latest = {}
+        for i in range(0, len(room_ids), chunk_size):
+            chunk = room_ids[i:i + chunk_size]
+            # Only fetch the rows with the highest index of each case. Ties are broken by the
+            # event ID like in latest_for_case.
+            latest_index = (select([cls.c.case, sql_func.max(cls.c.index).label("index")])
+                            .where(cls.c.case.in_(chunk))
+                            .group_by(cls.c.case)
+                            .alias("latest_index"))
+            rows = cls.db.execute(cls._make_simple_select(cls.c.case == latest_index.c.case,
+                                                          cls.c.index == latest_index.c.index)
+                                  .order_by(cls.c.case, cls.c.event_id))
+            for ctrl in cls._all(rows):
+                latest[ctrl.case] = ctrl
+        return latest
+
+    @classmethod
+    @in_executor
+    def all_for_case(cls, room_id: RoomID) -> List['ControlEvent']:
+        return list(cls._all(cls.db.execute(cls._make_simple_select(cls.c.case == room_id)
+                                            .order_by(cls.c.index.desc(),
+                                                      cls.c.event_id.desc()))))
+
+    @classmethod
+    @in_executor
+    def prune_superseded(cls, before: int, limit: int) -> List[EventID]:
+        # Deletes control events that have been replaced by a newer one for the same case, along
+        # with the claims of them
+        newer = cls.t.alias("newer")
+        case_accept = cls.metadata.tables["case_accept"]
+        with cls.db.begin() as conn:
+            event_ids = [row[0] for row in conn.execute(
+                select([cls.c.event_id])
+                .where(and_(cls.c.timestamp < before,
+                            exists().where(and_(newer.c.case == cls.c.case,
+                                                newer.c.index > cls.c.index))))
+                .limit(limit))]
+            if event_ids:
+                conn.execute(case_accept.delete()
+                             .where(case_accept.c.control_event.in_(event_ids)))
+                conn.execute(cls.t.delete().where(cls.c.event_id.in_(event_ids)))
+        return event_ids
 
 
-class CaseAccept(BaseClass):
+class CaseAccept(AsyncBaseClass):
     __tablename__ = "case_accept"
-    __table_args__ = (UniqueConstraint("control_event", "user_id"),)
     event_id: EventID = Column(String(255), primary_key=True)
     control_event: EventID = Column(String(255), nullable=False)
     case: RoomID = Column(String(255), nullable=False)
     user_id: UserID = Column(String(255), nullable=False)
 
+    @declared_attr
+    def __table_args__(self) -> Tuple[UniqueConstraint, ...]:
+        return UniqueConstraint("control_event", "user_id"),
+
     @classmethod
+    @in_executor
     def delete_by_id(cls, event_id: EventID) -> None:
         cls.db.execute(cls.t.delete().where(cls.c.event_id == event_id))
 
     @classmethod
+    @in_executor
     def delete_by_ctrl(cls, control_event: EventID, user_id: UserID) -> None:
         cls.db.execute(cls.t.delete().where(cls.c.control_event == control_event,
                                             cls.c.user_id == user_id))
 
     @classmethod
+    @in_executor
+    def all_by_ctrl(cls, control_event: EventID) -> List['CaseAccept']:
+        return list(cls._select_all(cls.c.control_event == control_event))
+
+    @classmethod
+    @in_executor
     def get_by_ctrl(cls, control_event: EventID, user_id: UserID) -> Optional['CaseAccept']:
         return cls._select_one_or_none(cls.c.control_event == control_event,
                                        cls.c.user_id == user_id)
+
+
+class Agent(AsyncBaseClass):
+    __tablename__ = "agent"
+    room_id: RoomID = Column(String(255), primary_key=True)
+    user_id: UserID = Column(String(255), primary_key=True)
+
+    @classmethod
+    @in_executor
+    def all(cls) -> List['Agent']:
+        return list(cls._select_all())
+
+    @classmethod
+    @in_executor
+    def all_in_room(cls, room_id: RoomID) -> List['Agent']:
+        return list(cls._select_all(cls.c.room_id == room_id))
+
+    @classmethod
+    @in_executor
+    def replace_room(cls, room_id: RoomID, user_ids: Iterable[UserID]) -> None:
+        with cls.db.begin() as conn:
+            conn.execute(cls.t.delete().where(cls.c.room_id == room_id))
+            rows = [{"room_id": room_id, "user_id": user_id} for user_id in user_ids]
+            if rows:
+                conn.execute(cls.t.insert(), rows)
+
+
+class ArchivedCase(AsyncBaseClass):
+    __tablename__ = "case_archive"
+    id: int = Column(Integer, primary_key=True, autoincrement=True)
+    room_id: RoomID = Column(String(255), nullable=False, index=True)
+    room_name: str = Column(Text, nullable=False)
+    user_id: UserID = Column(String(255), nullable=True)
+    displayname: str = Column(Text, nullable=True)
+    last_bot_msg: int = Column(BigInteger, nullable=False)
+    closed_at: Optional[int] = Column(BigInteger, nullable=True)
+    archived_at: int = Column(BigInteger, nullable=False)
+
+
+class Lease(AsyncBaseClass):
+    # Keys are case or control room IDs, or the names of jobs that only one instance should run
+    __tablename__ = "lease"
+    key: str = Column(String(255), primary_key=True)
+    owner: str = Column(String(255), nullable=False)
+    expires_at: int = Column(BigInteger, nullable=False)
+
+    @classmethod
+    @in_executor
+    def acquire(cls, key: str, owner: str, now: int, expires_at: int) -> Tuple[str, int]:
+        # Takes the lease if it's free, expired or already ours. Returns the owner and expiry
+        # time of the lease after the attempt.
+        result = cls.db.execute(cls.t.update()
+                                .where(and_(cls.c.key == key,
+                                            or_(cls.c.owner == owner, cls.c.expires_at < now)))
+                                .values(owner=owner, expires_at=expires_at))
+        if result.rowcount:
+            return owner, expires_at
+        try:
+            cls.db.execute(cls.t.insert().values(key=key, owner=owner, expires_at=expires_at))
+            return owner, expires_at
+        except IntegrityError:
+            row = cls.db.execute(select([cls.c.owner, cls.c.expires_at])
+                                 .where(cls.c.key == key)).first()
+            return (row[0], row[1]) if row else ("", 0)
+
+    @classmethod
+    @in_executor
+    def renew(cls, owner: str, expires_at: int) -> List[str]:
+        # Extends all leases of the owner and returns the keys it still holds
+        with cls.db.begin() as conn:
+            conn.execute(cls.t.update().where(cls.c.owner == owner).values(expires_at=expires_at))
+            return [row[0] for row in conn.execute(select([cls.c.key])
+                                                   .where(cls.c.owner == owner))]
+
+    @classmethod
+    @in_executor
+    def release(cls, owner: str, keys: Optional[List[str]] = None) -> None:
+        where = cls.c.owner == owner
+        if keys is not None:
+            where = and_(where, cls.c.key.in_(keys))
+        cls.db.execute(cls.t.delete().where(where))
+
+    @classmethod
+    @in_executor
+    def prune(cls, before: int) -> None:
+        # Leases of instances that stopped without releasing them are never renewed again
+        cls.db.execute(cls.t.delete().where(cls.c.expires_at < before))
+
+
+class Invalidation(AsyncBaseClass):
+    # Tells other instances that the cached copy of something has changed in the database
+    __tablename__ = "invalidation"
+    id: int = Column(Integer, primary_key=True, autoincrement=True)
+    key: str = Column(String(255), nullable=False)
+    origin: str = Column(String(255), nullable=False)
+    created_at: int = Column(BigInteger, nullable=False, index=True)
+
+    @classmethod
+    @in_executor
+    def publish(cls, keys: Iterable[str], origin: str, created_at: int) -> None:
+        rows = [{"key": key, "origin": origin, "created_at": created_at} for key in keys]
+        if rows:
+            cls.db.execute(cls.t.insert(), rows)
+
+    @classmethod
+    @in_executor
+    def latest_id(cls) -> int:
+        return cls.db.execute(select([sql_func.max(cls.c.id)])).scalar() or 0
+
+    @classmethod
+    @in_executor
+    def since(cls, last_id: int, origin: str) -> List[Tuple[int, str]]:
+        return [(row[0], row[1]) for row in cls.db.execute(
+            select([cls.c.id, cls.c.key])
+            .where(and_(cls.c.id > last_id, cls.c.origin != origin))
+            .order_by(cls.c.id))]
+
+    @classmethod
+    @in_executor
+    def prune(cls, before: int) -> None:
+        cls.db.execute(cls.t.delete().where(cls.c.created_at < before))
+
+
+class Version(AsyncBaseClass):
+    __tablename__ = "version"
+    version: int = Column(Integer, primary_key=True)
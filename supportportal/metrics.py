@@ -0,0 +1,244 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, List, Tuple, Iterable, Callable, Awaitable, Any
+from time import perf_counter
+import asyncio
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Labels, float]
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _labels(labels: Dict[str, Any]) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+               for _, value in labels)
+    return "{" + ",".join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + "}"
+
+
+class Metric:
+    type: str = "untyped"
+    name: str
+    help: str
+
+    def __init__(self, name: str, help: str) -> None:
+        self.name = name
+        self.help = help
+
+    def samples(self) -> Iterable[Sample]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        lines += [f"{name}{_format_labels(labels)} {value}"
+                  for name, labels, value in self.samples()]
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+    values: Dict[Labels, float]
+
+    def __init__(self, name: str, help: str) -> None:
+        super().__init__(name, help)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels: Any) -> None:
+        key = _labels(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> Iterable[Sample]:
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+
+class Gauge(Metric):
+    type = "gauge"
+    values: Dict[Labels, float]
+
+    def __init__(self, name: str, help: str) -> None:
+        super().__init__(name, help)
+        self.values = {}
+
+    def set(self, value: float, **labels: Any) -> None:
+        self.values[_labels(labels)] = value
+
+    def samples(self) -> Iterable[Sample]:
+        for labels, value in self.values.items():
+            yield self.name, labels, value
+
+
+class Histogram(Metric):
+    type = "histogram"
+    buckets: Tuple[float, ...]
+    counts: Dict[Labels, List[int]]
+    sums: Dict[Labels, float]
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...] = DEFAULT_BUCKETS
+                 ) -> None:
+        super().__init__(name, help)
+        self.buckets = buckets
+        self.counts = {}
+        self.sums = {}
+
+    def observe(self, value: float, **labels: Any) -> None:
+        key = _labels(labels)
+        try:
+            counts = self.counts[key]
+        except KeyError:
+            counts = self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                counts[i] += 1
+                break
+        else:
+            counts[-1] += 1
+        self.sums[key] += value
+
+    def samples(self) -> Iterable[Sample]:
+        for labels, counts in self.counts.items():
+            total = 0
+            for bound, count in zip(self.buckets, counts):
+                total += count
+                yield f"{self.name}_bucket", labels + (("le", str(bound)),), total
+            total += counts[-1]
+            yield f"{self.name}_bucket", labels + (("le", "+Inf"),), total
+            yield f"{self.name}_sum", labels, self.sums[labels]
+            yield f"{self.name}_count", labels, total
+
+
+class Metrics:
+    handler_latency: Histogram
+    queue_wait: Histogram
+    queue_full_wait: Histogram
+    db_latency: Histogram
+    matrix_latency: Histogram
+    matrix_errors: Counter
+    time_to_claim: Histogram
+    cases: Gauge
+    unattended_cases: Gauge
+    cache_size: Gauge
+    cache_hits: Gauge
+    cache_misses: Gauge
+    cache_evictions: Gauge
+    template_renders: Gauge
+    template_render_time: Gauge
+    outbox_queued: Gauge
+    outbox_superseded: Gauge
+    outbox_rate_limits: Counter
+    unsaved_cases: Gauge
+    queued_events: Gauge
+    queued_rooms: Gauge
+    collapsed_events: Gauge
+    scheduled_reminders: Gauge
+    reminders_sent: Counter
+    owned_leases: Gauge
+
+    collectors: List[Callable[[], Awaitable[None]]]
+
+    def __init__(self) -> None:
+        self.handler_latency = Histogram("supportportal_handler_seconds",
+                                         "Time taken by event handlers")
+        self.queue_wait = Histogram("supportportal_room_queue_wait_seconds",
+                                    "Time events spend in room queues before being handled")
+        self.queue_full_wait = Histogram("supportportal_room_queue_full_wait_seconds",
+                                         "Time spent waiting for space in a full room queue")
+        self.db_latency = Histogram("supportportal_db_query_seconds",
+                                    "Database query latency, including executor queue time")
+        self.matrix_latency = Histogram("supportportal_matrix_request_seconds",
+                                        "Matrix API request latency by client method")
+        self.matrix_errors = Counter("supportportal_matrix_request_errors_total",
+                                     "Failed Matrix API requests by client method")
+        self.time_to_claim = Histogram("supportportal_time_to_claim_seconds",
+                                       "Time from a control room notice to the case being claimed",
+                                       buckets=(10, 30, 60, 120, 300, 600, 1800, 3600, 7200,
+                                                21600, 86400))
+        self.cases = Gauge("supportportal_cases", "Number of cases in the database by state")
+        self.unattended_cases = Gauge("supportportal_cases_without_agent",
+                                      "Number of cached cases whose room has no agents")
+        self.cache_size = Gauge("supportportal_cache_entries", "Number of entries in each cache")
+        self.cache_hits = Gauge("supportportal_cache_hits", "Cache hits since startup")
+        self.cache_misses = Gauge("supportportal_cache_misses", "Cache misses since startup")
+        self.cache_evictions = Gauge("supportportal_cache_evictions",
+                                     "Cache evictions since startup")
+        self.template_renders = Gauge("supportportal_template_renders",
+                                      "Template renders since startup")
+        self.template_render_time = Gauge("supportportal_template_render_seconds",
+                                          "Total time spent rendering each template")
+        self.outbox_queued = Gauge("supportportal_outbox_queued_requests",
+                                   "Outbound Matrix requests waiting to be sent")
+        self.outbox_superseded = Gauge("supportportal_outbox_superseded_requests",
+                                       "Queued requests replaced by a newer one before being sent")
+        self.outbox_rate_limits = Counter("supportportal_outbox_rate_limits_total",
+                                          "Outbound requests retried after being rate limited")
+        self.unsaved_cases = Gauge("supportportal_unsaved_cases",
+                                   "Cases with changes that haven't been written to the database")
+        self.queued_events = Gauge("supportportal_room_queue_events",
+                                   "Events waiting in room queues")
+        self.queued_rooms = Gauge("supportportal_room_queue_rooms",
+                                  "Rooms with events waiting to be handled")
+        self.collapsed_events = Gauge("supportportal_room_queue_collapsed_events",
+                                      "Queued events replaced by a newer event of the same kind")
+        self.scheduled_reminders = Gauge("supportportal_scheduled_reminders",
+                                         "Unclaimed cases with a pending control room reminder")
+        self.reminders_sent = Counter("supportportal_reminders_total",
+                                      "Reminders of unclaimed cases posted to control rooms")
+        self.owned_leases = Gauge("supportportal_owned_leases",
+                                  "Rooms and jobs leased to this instance")
+        self.collectors = []
+
+    @property
+    def all(self) -> List[Metric]:
+        return [value for value in vars(self).values() if isinstance(value, Metric)]
+
+    async def render(self) -> str:
+        for collector in self.collectors:
+            await collector()
+        return "\n".join(metric.render() for metric in self.all) + "\n"
+
+
+class InstrumentedClient:
+    # Proxies the Matrix client and measures every coroutine method that's called through it
+    _client: Any
+    _metrics: Metrics
+
+    def __init__(self, client: Any, metrics: Metrics) -> None:
+        self._client = client
+        self._metrics = metrics
+
+    def __getattr__(self, name: str) -> Any:
+        value = getattr(self._client, name)
+        if not asyncio.iscoroutinefunction(value):
+            return value
+
+        async def measured(*args, **kwargs) -> Any:
+            start = perf_counter()
+            try:
+                return await value(*args, **kwargs)
+            except Exception:
+                self._metrics.matrix_errors.inc(method=name)
+                raise
+            finally:
+                self._metrics.matrix_latency.observe(perf_counter() - start, method=name)
+
+        return measured
@@ -0,0 +1,74 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Callable, List, Type
+from logging import Logger
+
+from sqlalchemy import MetaData, select
+from sqlalchemy.engine.base import Engine, Connection
+
+from .db import Version
+
+Upgrade = Callable[[Connection, MetaData], None]
+upgrades: List[Upgrade] = []
+
+
+def register_upgrade(func: Upgrade) -> Upgrade:
+    upgrades.append(func)
+    return func
+
+
+@register_upgrade
+def add_control_event_case_index(conn: Connection, metadata: MetaData) -> None:
+    for index in metadata.tables["control_event"].indexes:
+        index.create(conn)
+
+
+@register_upgrade
+def add_case_state(conn: Connection, metadata: MetaData) -> None:
+    quote = conn.dialect.identifier_preparer.quote
+    table = metadata.tables["case"]
+    conn.execute(f"ALTER TABLE {quote('case')} ADD COLUMN state VARCHAR(16) NOT NULL "
+                 f"DEFAULT 'open'")
+    conn.execute(f"ALTER TABLE {quote('case')} ADD COLUMN closed_at BIGINT")
+    case_accept = metadata.tables["case_accept"]
+    conn.execute(table.update()
+                 .where(table.c.id.in_(select([case_accept.c.case])))
+                 .values(state="claimed"))
+    for index in table.indexes:
+        index.create(conn)
+
+
+@register_upgrade
+def add_case_control_room(conn: Connection, metadata: MetaData) -> None:
+    quote = conn.dialect.identifier_preparer.quote
+    conn.execute(f"ALTER TABLE {quote('case')} ADD COLUMN control_room VARCHAR(255)")
+
+
+def upgrade(engine: Engine, metadata: MetaData, version_table: Type[Version], log: Logger
+            ) -> None:
+    # Tables created from scratch by create_all already match the latest schema
+    is_new = not engine.has_table("case")
+    metadata.create_all()
+    with engine.begin() as conn:
+        row = conn.execute(version_table.t.select()).first()
+        version = row[0] if row else (0 if not is_new else len(upgrades))
+        for num, func in enumerate(upgrades[version:], start=version + 1):
+            log.info(f"Upgrading database to v{num}: {func.__name__}")
+            func(conn, metadata)
+        if not row:
+            conn.execute(version_table.t.insert().values(version=len(upgrades)))
+        elif version != len(upgrades):
+            conn.execute(version_table.t.update().values(version=len(upgrades)))
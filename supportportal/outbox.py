@@ -0,0 +1,222 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, List, Optional, Set
+from collections import deque
+from enum import IntEnum
+from itertools import count
+from logging import Logger
+import asyncio
+import json
+
+from mautrix.errors import MatrixRequestError, MLimitExceeded
+
+from .metrics import Metrics
+
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60
+
+
+class Priority(IntEnum):
+    CUSTOMER = 0
+    CONTROL = 1
+    STATUS = 2
+
+
+class _Request:
+    __slots__ = ("lane", "priority", "key", "func", "description", "future", "attempts")
+
+    lane: Hashable
+    priority: Priority
+    key: Optional[Hashable]
+    func: Callable[[], Awaitable[Any]]
+    description: str
+    future: asyncio.Future
+    attempts: int
+
+    def __init__(self, lane: Hashable, priority: Priority, key: Optional[Hashable],
+                 func: Callable[[], Awaitable[Any]], description: str,
+                 future: asyncio.Future) -> None:
+        self.lane = lane
+        self.priority = priority
+        self.key = key
+        self.func = func
+        self.description = description
+        self.future = future
+        self.attempts = 0
+
+
+def _is_rate_limit(error: Exception) -> bool:
+    return isinstance(error, MLimitExceeded) or (isinstance(error, MatrixRequestError)
+                                                 and getattr(error, "http_status", 0) == 429)
+
+
+def _retry_after(error: Exception, attempt: int) -> float:
+    # mautrix doesn't keep the response body of M_LIMIT_EXCEEDED errors, so only unknown errors
+    # (e.g. a 429 from a reverse proxy) can tell how long to wait. Others back off exponentially.
+    try:
+        retry_after_ms = json.loads(getattr(error, "text", None) or "{}").get("retry_after_ms")
+    except (ValueError, AttributeError):
+        retry_after_ms = None
+    if retry_after_ms:
+        return retry_after_ms / 1000
+    return min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX)
+
+
+# Dispatches outbound Matrix requests. Requests in the same lane are sent one at a time in
+# submission order, while different lanes are sent concurrently by a fixed number of workers that
+# pick the waiting lane with the most important request first. Rate limit errors pause all
+# workers for a backoff delay before retrying. A request submitted with a key replaces a
+# still queued request with the same key, so e.g. only the newest edit of an event is sent.
+class Outbox:
+    loop: asyncio.AbstractEventLoop
+    log: Logger
+    metrics: Metrics
+    concurrency: int
+    max_retries: int
+
+    lanes: Dict[Hashable, Deque[_Request]]
+    queued: Dict[Hashable, _Request]
+    ready: asyncio.PriorityQueue
+    workers: List[asyncio.Future]
+    paused_until: float
+    superseded: int
+    _active: Set[Hashable]
+    _seq: 'count[int]'
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, log: Logger, metrics: Metrics) -> None:
+        self.loop = loop
+        self.log = log
+        self.metrics = metrics
+        self.concurrency = 1
+        self.max_retries = 5
+        self.lanes = {}
+        self.queued = {}
+        self.ready = asyncio.PriorityQueue()
+        self.workers = []
+        self.paused_until = 0
+        self.superseded = 0
+        self._active = set()
+        self._seq = count()
+
+    def __len__(self) -> int:
+        return sum(len(requests) for requests in self.lanes.values())
+
+    def configure(self, concurrency: int, max_retries: int) -> None:
+        self.concurrency = max(concurrency, 1)
+        self.max_retries = max_retries
+        if self.workers:
+            self._scale_workers()
+
+    def start(self) -> None:
+        self._scale_workers()
+
+    def _scale_workers(self) -> None:
+        while len(self.workers) < self.concurrency:
+            self.workers.append(asyncio.ensure_future(self._worker(), loop=self.loop))
+        while len(self.workers) > self.concurrency:
+            self.workers.pop().cancel()
+
+    async def stop(self, timeout: float = 5) -> None:
+        if self.lanes:
+            try:
+                await asyncio.wait_for(self._drain(), timeout)
+            except asyncio.TimeoutError:
+                self.log.warning(f"Dropping {len(self)} queued requests on shutdown")
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        for requests in self.lanes.values():
+            for request in requests:
+                request.future.cancel()
+        self.lanes = {}
+        self.queued = {}
+        self._active = set()
+
+    async def _drain(self) -> None:
+        while self.lanes:
+            await asyncio.sleep(0.1)
+
+    def submit(self, func: Callable[[], Awaitable[Any]], lane: Hashable,
+               priority: Priority = Priority.CONTROL, key: Optional[Hashable] = None,
+               description: str = "send request") -> asyncio.Future:
+        if key is not None:
+            try:
+                request = self.queued[key]
+            except KeyError:
+                pass
+            else:
+                request.func = func
+                request.description = description
+                request.priority = min(request.priority, priority)
+                self.superseded += 1
+                return request.future
+        future = self.loop.create_future()
+        # Nobody has to wait for the result, failures are logged by the worker
+        future.add_done_callback(lambda fut: fut.cancelled() or fut.exception())
+        request = _Request(lane, priority, key, func, description, future)
+        if key is not None:
+            self.queued[key] = request
+        self.lanes.setdefault(lane, deque()).append(request)
+        if lane not in self._active:
+            self._schedule(lane, priority)
+        return future
+
+    def _schedule(self, lane: Hashable, priority: Priority) -> None:
+        self._active.add(lane)
+        self.ready.put_nowait((priority, next(self._seq), lane))
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, lane = await self.ready.get()
+            requests = self.lanes[lane]
+            request = requests.popleft()
+            if request.key is not None and self.queued.get(request.key) is request:
+                del self.queued[request.key]
+            try:
+                await self._send(request)
+            except asyncio.CancelledError:
+                request.future.cancel()
+                raise
+            finally:
+                if requests:
+                    self._schedule(lane, requests[0].priority)
+                else:
+                    self.lanes.pop(lane, None)
+                    self._active.discard(lane)
+
+    async def _send(self, request: _Request) -> None:
+        while True:
+            delay = self.paused_until - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            try:
+                result = await request.func()
+            except Exception as e:
+                if _is_rate_limit(e) and request.attempts < self.max_retries:
+                    retry_after = _retry_after(e, request.attempts)
+                    request.attempts += 1
+                    self.metrics.outbox_rate_limits.inc()
+                    self.paused_until = max(self.paused_until, self.loop.time() + retry_after)
+                    self.log.debug(f"Rate limited while trying to {request.description}, "
+                                   f"retrying in {retry_after:.2f} seconds")
+                    continue
+                self.log.warning(f"Failed to {request.description}: {e}")
+                if not request.future.done():
+                    request.future.set_exception(e)
+                return
+            if not request.future.done():
+                request.future.set_result(result)
+            return
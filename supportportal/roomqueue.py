@@ -0,0 +1,159 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional
+from collections import deque
+from logging import Logger
+from time import perf_counter
+import asyncio
+
+from .metrics import Metrics
+
+
+class _Job:
+    __slots__ = ("func", "collapse_key", "future", "queued_at")
+
+    func: Callable[[], Awaitable[Any]]
+    collapse_key: Optional[Hashable]
+    future: asyncio.Future
+    queued_at: float
+
+    def __init__(self, func: Callable[[], Awaitable[Any]], collapse_key: Optional[Hashable],
+                 future: asyncio.Future) -> None:
+        self.func = func
+        self.collapse_key = collapse_key
+        self.future = future
+        self.queued_at = perf_counter()
+
+
+# Runs the jobs of each room one at a time in submission order, with up to `concurrency` jobs of
+# different rooms running at the same time. A room has a worker task only while it has queued
+# jobs. When a room's queue is full, submitting waits until there's space again. A job submitted
+# with a collapse key replaces the last queued job of the room if it has the same key, so
+# e.g. a burst of messages is only handled once.
+class RoomQueues:
+    loop: asyncio.AbstractEventLoop
+    log: Logger
+    metrics: Metrics
+    max_depth: int
+    collapsed: int
+
+    queues: Dict[Hashable, Deque[_Job]]
+    workers: Dict[Hashable, asyncio.Future]
+    _waiters: Dict[Hashable, Deque[asyncio.Future]]
+    _semaphore: asyncio.Semaphore
+    _concurrency: int
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, log: Logger, metrics: Metrics) -> None:
+        self.loop = loop
+        self.log = log
+        self.metrics = metrics
+        self.max_depth = 1
+        self.collapsed = 0
+        self.queues = {}
+        self.workers = {}
+        self._waiters = {}
+        self._concurrency = 1
+        self._semaphore = asyncio.Semaphore(1)
+
+    def __len__(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    def configure(self, concurrency: int, max_depth: int) -> None:
+        self.max_depth = max(max_depth, 1)
+        concurrency = max(concurrency, 1)
+        # Running jobs keep using the old semaphore, so the new limit applies to new jobs only
+        if concurrency != self._concurrency:
+            self._concurrency = concurrency
+            self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def submit(self, key: Hashable, func: Callable[[], Awaitable[Any]],
+                     collapse_key: Optional[Hashable] = None) -> asyncio.Future:
+        queue = self.queues.get(key)
+        if (collapse_key is not None and queue and queue[-1].collapse_key == collapse_key
+                and key not in self._waiters):
+            queue[-1].func = func
+            self.collapsed += 1
+            return queue[-1].future
+        if key in self._waiters or (queue is not None and len(queue) >= self.max_depth):
+            await self._wait_for_space(key)
+        future = self.loop.create_future()
+        # Nobody has to wait for the result, failures are logged by the worker
+        future.add_done_callback(lambda fut: fut.cancelled() or fut.exception())
+        self.queues.setdefault(key, deque()).append(_Job(func, collapse_key, future))
+        if key not in self.workers:
+            self.workers[key] = asyncio.ensure_future(self._run(key), loop=self.loop)
+        return future
+
+    async def _wait_for_space(self, key: Hashable) -> None:
+        waiter = self.loop.create_future()
+        waiters = self._waiters.setdefault(key, deque())
+        waiters.append(waiter)
+        start = perf_counter()
+        try:
+            await waiter
+        except BaseException:
+            # Pass the wakeup on to the next waiter if this one won't use it
+            if waiter.done() and not waiter.cancelled():
+                self._wake(key)
+            raise
+        finally:
+            waiters.remove(waiter)
+            if not waiters:
+                del self._waiters[key]
+            self.metrics.queue_full_wait.observe(perf_counter() - start)
+
+    def _wake(self, key: Hashable) -> None:
+        for waiter in self._waiters.get(key, ()):
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    async def _run(self, key: Hashable) -> None:
+        queue = self.queues[key]
+        try:
+            while queue:
+                async with self._semaphore:
+                    job = queue.popleft()
+                    self._wake(key)
+                    self.metrics.queue_wait.observe(perf_counter() - job.queued_at)
+                    try:
+                        result = await job.func()
+                    except asyncio.CancelledError:
+                        job.future.cancel()
+                        raise
+                    except Exception as e:
+                        self.log.exception(f"Failed to handle event in {key}")
+                        job.future.set_exception(e)
+                    else:
+                        job.future.set_result(result)
+        finally:
+            if self.queues.get(key) is queue and not queue:
+                del self.queues[key]
+            if self.workers.get(key) is asyncio.current_task(loop=self.loop):
+                del self.workers[key]
+
+    async def stop(self, timeout: float = 5) -> None:
+        if self.workers:
+            done, pending = await asyncio.wait(list(self.workers.values()), timeout=timeout)
+            if pending:
+                self.log.warning(f"Dropping {len(self)} queued events on shutdown")
+        for worker in self.workers.values():
+            worker.cancel()
+        for queue in self.queues.values():
+            for job in queue:
+                job.future.cancel()
+        self.workers = {}
+        self.queues = {}
@@ -0,0 +1,92 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, Dict, List, Optional, Pattern, Tuple
+from collections import Counter
+import re
+
+from mautrix.types import RoomID, UserID
+
+Rule = Tuple[Optional[str], Optional[Pattern], RoomID]
+
+
+# Decides which control room new cases are announced in. Rules are checked in order, and cases
+# that don't match any of them are spread over the shards, or sent to the default control room
+# if there are no shards.
+class CaseRouter:
+    default: Optional[RoomID]
+    shards: List[RoomID]
+    strategy: str
+    rules: List[Rule]
+    control_rooms: List[RoomID]
+    load: 'Counter[RoomID]'
+    _next_shard: int
+
+    def __init__(self) -> None:
+        self.default = None
+        self.shards = []
+        self.strategy = "round_robin"
+        self.rules = []
+        self.control_rooms = []
+        self.load = Counter()
+        self._next_shard = 0
+
+    def configure(self, default: Optional[RoomID], routing: Dict[str, Any]) -> None:
+        self.default = default
+        self.shards = list(routing["shards"] or [])
+        self.strategy = routing["strategy"]
+        if self.strategy not in ("round_robin", "least_loaded"):
+            raise ValueError(f"Unknown routing strategy {self.strategy}")
+        self.rules = [(rule.get("server"),
+                       re.compile(rule["room_name"]) if rule.get("room_name") else None,
+                       rule["control_room"])
+                      for rule in routing["rules"] or []]
+        self._update_control_rooms()
+
+    def set_default(self, room_id: RoomID) -> None:
+        self.default = room_id
+        self._update_control_rooms()
+
+    def _update_control_rooms(self) -> None:
+        rooms = [self.default] + self.shards + [room_id for _, _, room_id in self.rules]
+        self.control_rooms = list(dict.fromkeys(room_id for room_id in rooms if room_id))
+
+    def set_load(self, counts: Dict[Optional[RoomID], int]) -> None:
+        self.load = Counter()
+        for room_id, count in counts.items():
+            self.load[room_id or self.default] += count
+
+    def route(self, inviter: UserID, room_name: str) -> Optional[RoomID]:
+        server = inviter.split(":", 1)[1] if ":" in inviter else ""
+        for rule_server, name_pattern, room_id in self.rules:
+            if rule_server is not None and rule_server != server:
+                continue
+            elif name_pattern is not None and not name_pattern.search(room_name or ""):
+                continue
+            return room_id
+        if not self.shards:
+            return self.default
+        elif self.strategy == "least_loaded":
+            return min(self.shards, key=lambda room_id: self.load[room_id])
+        room_id = self.shards[self._next_shard % len(self.shards)]
+        self._next_shard += 1
+        return room_id
+
+    def opened(self, room_id: Optional[RoomID]) -> None:
+        self.load[room_id or self.default] += 1
+
+    def closed(self, room_id: Optional[RoomID]) -> None:
+        room_id = room_id or self.default
+        self.load[room_id] = max(self.load[room_id] - 1, 0)
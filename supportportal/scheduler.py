@@ -0,0 +1,109 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Awaitable, Callable, Dict, Hashable, List, Optional, Tuple
+from heapq import heapify, heappop, heappush
+from itertools import count
+from logging import Logger
+from time import time
+import asyncio
+
+DueHandler = Callable[[List[Hashable]], Awaitable[None]]
+
+
+# Keeps one deadline (a timestamp in milliseconds) per key and calls the handler with the keys
+# whose deadline has passed, up to `batch_size` keys at a time. Rescheduling or cancelling a key
+# only updates the dict, the outdated heap entry is skipped once it reaches the top.
+class Scheduler:
+    loop: asyncio.AbstractEventLoop
+    log: Logger
+    handler: DueHandler
+    batch_size: int
+
+    deadlines: Dict[Hashable, int]
+    heap: List[Tuple[int, int, Hashable]]
+    task: Optional[asyncio.Future]
+    _wakeup: asyncio.Event
+    _seq: 'count[int]'
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, log: Logger, handler: DueHandler) -> None:
+        self.loop = loop
+        self.log = log
+        self.handler = handler
+        self.batch_size = 100
+        self.deadlines = {}
+        self.heap = []
+        self.task = None
+        self._wakeup = asyncio.Event()
+        self._seq = count()
+
+    def __len__(self) -> int:
+        return len(self.deadlines)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.deadlines
+
+    def configure(self, batch_size: int) -> None:
+        self.batch_size = max(batch_size, 1)
+
+    def start(self) -> None:
+        self.task = asyncio.ensure_future(self._run(), loop=self.loop)
+
+    async def stop(self) -> None:
+        if self.task:
+            self.task.cancel()
+            self.task = None
+
+    def schedule(self, key: Hashable, deadline: int) -> None:
+        if self.deadlines.get(key) == deadline:
+            return
+        self.deadlines[key] = deadline
+        heappush(self.heap, (deadline, next(self._seq), key))
+        if self.heap[0][0] == deadline:
+            # The timer loop is sleeping until a later deadline
+            self._wakeup.set()
+        # Don't let outdated entries pile up when deadlines keep being moved
+        if len(self.heap) > 2 * len(self.deadlines) + 64:
+            self.heap = [(deadline, next(self._seq), key)
+                         for key, deadline in self.deadlines.items()]
+            heapify(self.heap)
+
+    def cancel(self, key: Hashable) -> None:
+        self.deadlines.pop(key, None)
+
+    def _pop_due(self, now: int) -> List[Hashable]:
+        due = []
+        while self.heap and self.heap[0][0] <= now and len(due) < self.batch_size:
+            deadline, _, key = heappop(self.heap)
+            if self.deadlines.get(key) == deadline:
+                del self.deadlines[key]
+                due.append(key)
+        return due
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            due = self._pop_due(int(time() * 1000))
+            if due:
+                try:
+                    await self.handler(due)
+                except Exception:
+                    self.log.exception(f"Failed to handle {len(due)} due timers")
+                continue
+            timeout = (self.heap[0][0] - time() * 1000) / 1000 if self.heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,241 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Tuple
+from urllib.parse import quote
+from logging import Logger
+from time import time
+import asyncio
+import json
+import gzip
+import os
+import re
+
+from mautrix.types import EventType, PaginationDirection, RoomID
+from mautrix.client import Client
+from mautrix.errors import MatrixResponseError
+
+LIVE = "live"
+BACKFILL = "backfill"
+READ_CHUNK_SIZE = 64 * 1024
+SEGMENT_RE = re.compile(r"^(live|backfill)-(\d+)\.jsonl\.gz$")
+
+
+# Stores the messages of each case room in gzip-compressed JSONL files in a directory per room.
+# Live messages are buffered and appended as one gzip member per room and flush, and history
+# fetched by a backfill goes into separate files that come before the live ones. Both are split
+# into numbered segments of roughly `max_file_size` bytes. Concatenated gzip members are a valid
+# gzip file, so a transcript can be exported by streaming the segments as-is.
+class TranscriptStore:
+    loop: asyncio.AbstractEventLoop
+    log: Logger
+    directory: Optional[str]
+    max_file_size: int
+    interval: float
+    max_pending: int
+
+    buffers: Dict[RoomID, List[str]]
+    segments: Dict[Tuple[RoomID, str], int]
+    backfilling: Set[RoomID]
+    flush_task: Optional[asyncio.Future]
+    _pending: int
+    _flush_lock: asyncio.Lock
+
+    def __init__(self, loop: asyncio.AbstractEventLoop, log: Logger) -> None:
+        self.loop = loop
+        self.log = log
+        self.directory = None
+        self.max_file_size = 0
+        self.interval = 10
+        self.max_pending = 1000
+        self.buffers = {}
+        self.segments = {}
+        self.backfilling = set()
+        self.flush_task = None
+        self._pending = 0
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return self._pending
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.directory)
+
+    def configure(self, directory: Optional[str], max_file_size: int, interval: float,
+                  max_pending: int) -> None:
+        if directory != self.directory:
+            self.segments = {}
+        self.directory = directory
+        self.max_file_size = max_file_size
+        self.interval = interval
+        self.max_pending = max_pending
+
+    def start(self) -> None:
+        self.flush_task = asyncio.ensure_future(self._flush_loop(), loop=self.loop)
+
+    async def stop(self) -> None:
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            self.log.exception(f"Failed to write {self._pending} buffered transcript lines "
+                               "on shutdown")
+
+    def append(self, room_id: RoomID, event: Dict[str, Any]) -> None:
+        if not self.enabled:
+            return
+        self.buffers.setdefault(room_id, []).append(json.dumps(event, ensure_ascii=False))
+        self._pending += 1
+        if self._pending >= self.max_pending and not self._flush_lock.locked():
+            asyncio.ensure_future(self._flush_logged(), loop=self.loop)
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval if self.interval > 0 else 1)
+            await self._flush_logged()
+
+    async def _flush_logged(self) -> None:
+        try:
+            await self.flush()
+        except Exception:
+            self.log.exception("Failed to write transcripts")
+
+    async def flush(self, room_id: Optional[RoomID] = None) -> None:
+        async with self._flush_lock:
+            if room_id:
+                buffers = {room_id: self.buffers.pop(room_id)} if room_id in self.buffers else {}
+            else:
+                buffers, self.buffers = self.buffers, {}
+            if not buffers or not self.enabled:
+                return
+            self._pending -= sum(len(lines) for lines in buffers.values())
+            try:
+                await self.loop.run_in_executor(None, self._write_all, buffers)
+            except Exception:
+                for room_id, lines in buffers.items():
+                    self.buffers[room_id] = lines + self.buffers.get(room_id, [])
+                    self._pending += len(lines)
+                raise
+
+    def _write_all(self, buffers: Dict[RoomID, List[str]]) -> None:
+        for room_id, lines in buffers.items():
+            self._write(room_id, LIVE, lines)
+
+    def room_dir(self, room_id: RoomID) -> str:
+        return os.path.join(self.directory, quote(room_id, safe=""))
+
+    def _list_segments(self, room_id: RoomID) -> List[Tuple[str, int, str]]:
+        try:
+            names = os.listdir(self.room_dir(room_id))
+        except FileNotFoundError:
+            return []
+        segments = []
+        for name in names:
+            match = SEGMENT_RE.match(name)
+            if match:
+                segments.append((match.group(1), int(match.group(2)), name))
+        # Backfilled history comes before everything that was recorded live
+        segments.sort(key=lambda segment: (segment[0] != BACKFILL, segment[1]))
+        return segments
+
+    def paths(self, room_id: RoomID) -> List[str]:
+        room_dir = self.room_dir(room_id)
+        return [os.path.join(room_dir, name) for _, _, name in self._list_segments(room_id)]
+
+    def _write(self, room_id: RoomID, kind: str, lines: List[str]) -> None:
+        key = (room_id, kind)
+        try:
+            index = self.segments[key]
+        except KeyError:
+            os.makedirs(self.room_dir(room_id), exist_ok=True)
+            index = max((segment_index for segment_kind, segment_index, _
+                         in self._list_segments(room_id) if segment_kind == kind), default=0)
+        path = os.path.join(self.room_dir(room_id), f"{kind}-{index:06d}.jsonl.gz")
+        if (self.max_file_size > 0 and os.path.exists(path)
+                and os.path.getsize(path) >= self.max_file_size):
+            index += 1
+            path = os.path.join(self.room_dir(room_id), f"{kind}-{index:06d}.jsonl.gz")
+        self.segments[key] = index
+        with gzip.open(path, "at", encoding="utf-8") as file:
+            for line in lines:
+                file.write(line)
+                file.write("\n")
+
+    def _first_live_timestamp(self, room_id: RoomID) -> Optional[int]:
+        for kind, _, name in self._list_segments(room_id):
+            if kind != LIVE:
+                continue
+            with gzip.open(os.path.join(self.room_dir(room_id), name), "rt",
+                           encoding="utf-8") as file:
+                line = file.readline()
+            if line:
+                return json.loads(line).get("origin_server_ts")
+        return None
+
+    async def backfill(self, client: Client, room_id: RoomID, page_size: int) -> Optional[int]:
+        # Pages through the room history from the beginning until the first message that was
+        # recorded live, writing one page at a time. Returns None if the room was already
+        # backfilled or is being backfilled.
+        if room_id in self.backfilling:
+            return None
+        self.backfilling.add(room_id)
+        try:
+            segments = await self.loop.run_in_executor(None, self._list_segments, room_id)
+            if any(kind == BACKFILL for kind, _, _ in segments):
+                return None
+            await self.flush(room_id)
+            cutoff = (await self.loop.run_in_executor(None, self._first_live_timestamp, room_id)
+                      or int(time() * 1000))
+            count = 0
+            token = None
+            while True:
+                # mautrix sends the filter with the wrong parameter name, so the homeserver
+                # ignores it and other events are filtered out here instead
+                try:
+                    page = await client.get_messages(room_id, PaginationDirection.FORWARD,
+                                                     from_token=token, limit=page_size)
+                except MatrixResponseError:
+                    # The empty page after the end of the history may not have an end token,
+                    # which mautrix treats as an invalid response
+                    if token is None:
+                        raise
+                    return count
+                events = [evt for evt in page.events if evt.timestamp < cutoff]
+                lines = [json.dumps(evt.serialize(), ensure_ascii=False) for evt in events
+                         if evt.type == EventType.ROOM_MESSAGE]
+                if lines:
+                    await self.loop.run_in_executor(None, self._write, room_id, BACKFILL,
+                                                    lines)
+                    count += len(lines)
+                if (len(events) < len(page.events) or len(page.events) < page_size
+                        or not page.end or page.end == token):
+                    return count
+                token = page.end
+        finally:
+            self.backfilling.discard(room_id)
+
+    async def read(self, room_id: RoomID) -> AsyncIterator[bytes]:
+        # Yields the raw gzip data of the transcript in chunks, one chunk in memory at a time
+        await self.flush(room_id)
+        for path in await self.loop.run_in_executor(None, self.paths, room_id):
+            with open(path, "rb") as file:
+                while True:
+                    chunk = await self.loop.run_in_executor(None, file.read, READ_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    yield chunk
@@ -13,7 +13,9 @@
 #
 # You should have received a copy of the GNU Affero General Public License
 # along with this program.  If not, see <https://www.gnu.org/licenses/>.
-from typing import Callable, Awaitable, Union, TYPE_CHECKING
+from typing import Callable, Awaitable, Optional, Union, Any, TYPE_CHECKING
+from functools import partial, wraps
+from time import perf_counter
 
 from mautrix.types import StateEvent, MessageEvent
 
@@ -27,25 +29,61 @@ EventHandler = Callable[['SupportPortalBot', RoomEvent], Awaitable[None]]
 CasefulEventHandler = Callable[['SupportPortalBot', RoomEvent, Case], Awaitable[None]]
 
 
-def with_case(func: CasefulEventHandler) -> EventHandler:
-    @lock_room
+def with_case(func: Optional[CasefulEventHandler] = None, *, collapse: bool = False
+              ) -> Union[EventHandler, Callable[[CasefulEventHandler], EventHandler]]:
+    if func is None:
+        return partial(with_case, collapse=collapse)
+
+    @queued(collapse=collapse)
+    @wraps(func)
     async def caseful_handler(self: 'SupportPortalBot', evt: RoomEvent) -> None:
-        case = self.get_case(evt.room_id)
+        case = await self.get_case(evt.room_id)
         if case:
-            return await func(self, evt, case)
+            await func(self, evt, case)
+            await self.release_closed_case(case)
+
+    @wraps(func)
+    async def case_room_handler(self: 'SupportPortalBot', evt: RoomEvent) -> None:
+        # Rooms that aren't cases are skipped before leasing them
+        if await self.get_case(evt.room_id):
+            await caseful_handler(self, evt)
+
+    return case_room_handler
+
+
+def queued(func: Optional[EventHandler] = None, *, collapse: bool = False
+           ) -> Union[EventHandler, Callable[[EventHandler], EventHandler]]:
+    # Handlers run in the worker of the room's queue, the dispatched task only queues the event.
+    # With collapse, an event replaces the previous event of the room if it's still queued for
+    # the same handler.
+    if func is None:
+        return partial(queued, collapse=collapse)
+    collapse_key = func.__name__ if collapse else None
+
+    @wraps(func)
+    async def queued_handler(self: 'SupportPortalBot', evt: RoomEvent) -> None:
+        # Events of rooms leased to another instance are skipped before being queued
+        if not await self.coordinator.owns(evt.room_id):
+            return
+        await self.room_queues.submit(evt.room_id, partial(func, self, evt), collapse_key)
 
-    return caseful_handler
+    return queued_handler
 
 
-def lock_room(func: EventHandler) -> EventHandler:
-    async def locked_handler(self: 'SupportPortalBot', evt: RoomEvent) -> None:
-        async with self.locks[evt.room_id]:
-            return await func(self, evt)
+def timed_handler(func: Callable[..., Awaitable[None]]) -> Callable[..., Awaitable[None]]:
+    @wraps(func)
+    async def timed(self: 'SupportPortalBot', evt: RoomEvent, *args: Any) -> None:
+        start = perf_counter()
+        try:
+            return await func(self, evt, *args)
+        finally:
+            self.metrics.handler_latency.observe(perf_counter() - start, handler=func.__name__)
 
-    return locked_handler
+    return timed
 
 
 def ignore_control_bot(func: EventHandler) -> EventHandler:
+    @wraps(func)
     async def ignoring_handler(self: 'SupportPortalBot', evt: RoomEvent) -> None:
         if evt.state_key == self.client.mxid:
             return
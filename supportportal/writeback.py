@@ -0,0 +1,113 @@
+# supportportal - A maubot plugin to manage customer support on Matrix.
+# Copyright (C) 2019 Tulir Asokan
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU Affero General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Affero General Public License for more details.
+#
+# You should have received a copy of the GNU Affero General Public License
+# along with this program.  If not, see <https://www.gnu.org/licenses/>.
+from typing import Dict, Set, Type, Iterable, Optional, Any
+from logging import Logger
+import asyncio
+
+from mautrix.types import RoomID
+
+from .db import Case
+
+
+# Keeps changes to cases in memory and writes them to the database in batches. The Case objects
+# with unsaved changes are authoritative until they're flushed, so they must be looked up here
+# before loading a case from the database.
+class CaseWriter:
+    table: Type[Case]
+    loop: asyncio.AbstractEventLoop
+    log: Logger
+    interval: float
+    max_pending: int
+    write_through: Set[str]
+
+    cases: Dict[RoomID, Case]
+    dirty: Dict[RoomID, Set[str]]
+    flush_task: Optional[asyncio.Future]
+    _flush_lock: asyncio.Lock
+
+    def __init__(self, table: Type[Case], loop: asyncio.AbstractEventLoop, log: Logger) -> None:
+        self.table = table
+        self.loop = loop
+        self.log = log
+        self.interval = 0
+        self.max_pending = 0
+        self.write_through = set()
+        self.cases = {}
+        self.dirty = {}
+        self.flush_task = None
+        self._flush_lock = asyncio.Lock()
+
+    def __len__(self) -> int:
+        return len(self.dirty)
+
+    def configure(self, interval: float, max_pending: int, write_through: Iterable[str]) -> None:
+        self.interval = interval
+        self.max_pending = max_pending
+        self.write_through = set(write_through)
+
+    def start(self) -> None:
+        self.flush_task = asyncio.ensure_future(self._flush_loop(), loop=self.loop)
+
+    async def stop(self) -> None:
+        if self.flush_task:
+            self.flush_task.cancel()
+            self.flush_task = None
+        try:
+            await self.flush()
+        except Exception:
+            self.log.exception(f"Failed to save changes to {len(self.dirty)} cases on shutdown")
+
+    def get(self, room_id: RoomID) -> Optional[Case]:
+        return self.cases.get(room_id)
+
+    def forget(self, room_id: RoomID) -> None:
+        self.cases.pop(room_id, None)
+        self.dirty.pop(room_id, None)
+
+    async def edit(self, case: Case, **values: Any) -> None:
+        for key, value in values.items():
+            setattr(case, key, value)
+        self.cases[case.id] = case
+        self.dirty.setdefault(case.id, set()).update(values.keys())
+        if (self.interval <= 0 or len(self.dirty) >= self.max_pending
+                or not self.write_through.isdisjoint(values.keys())):
+            await self.flush()
+
+    async def _flush_loop(self) -> None:
+        while True:
+            await asyncio.sleep(self.interval if self.interval > 0 else 1)
+            try:
+                await self.flush()
+            except Exception:
+                self.log.exception("Failed to save case changes")
+
+    async def flush(self) -> None:
+        async with self._flush_lock:
+            if not self.dirty:
+                return
+            dirty, self.dirty = self.dirty, {}
+            # Values are read at flush time, so each row gets the latest value of each field
+            changes = {room_id: {key: getattr(self.cases[room_id], key) for key in keys}
+                       for room_id, keys in dirty.items()}
+            try:
+                await self.table.edit_many(changes)
+            except Exception:
+                for room_id, keys in dirty.items():
+                    self.dirty.setdefault(room_id, set()).update(keys)
+                raise
+            for room_id in dirty:
+                if room_id not in self.dirty:
+                    self.cases.pop(room_id, None)